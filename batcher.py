@@ -0,0 +1,84 @@
+import queue
+import threading
+import time
+
+from concurrent.futures import Future
+
+
+class Batcher:
+    """
+    Class Batcher.
+    Collecting frames from concurrent callers (i.e. several cameras) into micro-batches.
+    Running each micro-batch through the model in one batched forward and NMS, and scattering the outputs back.
+    """
+    def __init__(self, model, max_batch=8, max_wait_ms=10, **kwargs):
+        """
+        :param: model: the model instance.
+        :param: max_batch: the maximum number of frames in a batch.
+        :param: max_wait_ms: the maximum time (milliseconds) the first frame of a batch waits for more frames.
+        :param: kwargs: inference arguments for Model.infer(), i.e. conf_thres.
+        :return: a Batcher instance.
+        """
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1E3
+        self.kwargs = kwargs
+        self.queue = queue.Queue()
+
+        # start the thread.
+        t = threading.Thread(target=self._worker)
+        t.daemon = True
+        t.start()
+
+    def submit(self, frame, image_id):
+        """
+        Queueing a frame for the next batch.
+        :param: frame: BGR image.
+        :param: image_id: the frame's image ID.
+        :return: a Future of the frame's output dictionary.
+        """
+        future = Future()
+        self.queue.put((frame, image_id, future))
+        return future
+
+    def infer(self, frame, image_id, timeout=None):
+        """
+        Inferring a frame as part of the next batch, waiting for its output.
+        :param: frame: BGR image.
+        :param: image_id: the frame's image ID.
+        :param: timeout: the maximum time (seconds) to wait for the output. None waits forever.
+        :return: output dictionary in the format {"image_id": ..., "detection_results": ...}
+        """
+        return self.submit(frame, image_id).result(timeout)
+
+    def _collect(self):
+        """
+        Collecting queued frames until max_batch frames or max_wait_ms since the first frame.
+        :return: list of (frame, image_id, future).
+        """
+        batch = [self.queue.get()]  # wait for the first frame
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _worker(self):
+        """
+        Running collected batches through the model and setting each frame's future.
+        """
+        while True:
+            frames, ids, futures = zip(*self._collect())
+            try:
+                outputs = self.model.infer(list(frames), ids=list(ids), **self.kwargs)
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+            else:
+                for future, output in zip(futures, outputs):
+                    future.set_result(output)
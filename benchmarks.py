@@ -0,0 +1,412 @@
+"""
+Inference server benchmarks on CPU
+
+Task                        | `benchmarks.py --task`        | Measures
+---                         | ---                           | ---
+Engine                      | `engine`                      | per-call overhead of a per-request vs. persistent engine
+Batching                    | `batching`                    | multi-camera throughput, one by one vs. micro-batched
+Swap                        | `swap`                        | weights hot swap latency and peak memory under traffic
+Workers                     | `workers`                     | multi-camera throughput, in process vs. worker pool
+Startup                     | `startup`                     | model load, checkpoint + fuse vs. cached fused model
+Warmup                      | `warmup`                      | first requests latency, without vs. with CPU warmup
+Compile                     | `compile`                     | PyTorch latency, eager vs. TorchScript vs. torch.compile
+Precision                   | `precision`                   | latency and accuracy, fp32 vs. channels-last vs. bfloat16
+Threads                     | `threads`                     | multi-camera latency and throughput over thread counts
+Augment                     | `augment`                     | augmented inference latency, per augmentation vs. batched
+Memory                      | `memory`                      | worker memory, private vs. memory-mapped weights
+Preprocess                  | `preprocess`                  | frame to tensor latency, conversion chain vs. single pass
+Codec                       | `codec`                       | JPEG encode/decode latency and size per codec backend
+Models                      | `models`                      | camera model cache, site and ensemble weights sharing
+
+Usage:
+    $ python benchmarks.py --weights best.pt --task engine
+    $ python benchmarks.py --weights best.pt best2.pt --task compile  # ensemble
+"""
+
+import argparse
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import torch
+
+FILE = Path(__file__).resolve()
+ROOT = FILE.parents[0]  # root directory
+if str(ROOT) not in sys.path:
+    sys.path.append(str(ROOT))  # add ROOT to PATH
+if platform.system() != 'Windows':
+    ROOT = Path(os.path.relpath(ROOT, Path.cwd()))  # relative
+
+from batcher import Batcher
+from export import sample_frames
+from model import Model
+from model_manager import ModelManager
+from worker_pool import WorkerPool
+from models.common import DetectMultiBackend
+from models.experimental import attempt_load
+from utils.augmentations import letterbox
+from utils.codec import BACKENDS, Codec
+from utils.general import LOGGER, colorstr, cv2, non_max_suppression, print_args, set_threads
+from utils.metrics import detections_ap
+
+TASKS = ('engine', 'batching', 'swap', 'workers', 'startup', 'warmup', 'compile', 'precision', 'threads', 'augment',
+         'memory', 'preprocess', 'codec', 'models')
+
+
+def synthetic_frames(n=1, shape=(1080, 1920, 3), seed=0):
+    # Random BGR uint8 frames standing in for camera frames
+    rng = np.random.default_rng(seed)
+    return [rng.integers(0, 256, shape, dtype=np.uint8) for _ in range(n)]
+
+
+def timeit(fn, n=20):
+    # Per-call wall times of fn() in ms
+    t = []
+    for _ in range(n):
+        t0 = time.perf_counter()
+        fn()
+        t.append((time.perf_counter() - t0) * 1E3)
+    return np.array(t)
+
+
+def summary(name, t):
+    # One result line: mean, p50 and p95 latency in ms
+    return f'{name:<40s}{t.mean():>10.1f}{np.percentile(t, 50):>10.1f}{np.percentile(t, 95):>10.1f}'
+
+
+def header():
+    return f"{'':<40s}{'mean ms':>10s}{'p50 ms':>10s}{'p95 ms':>10s}"
+
+
+def engine(weights, imgsz, device, n, frame_shape, **kwargs):
+    # Per-call overhead of constructing and warming the engine on every request (before) vs. a persistent one (after)
+    with tempfile.TemporaryDirectory() as d:
+        f = Path(d) / 'frame.jpg'
+        cv2.imwrite(str(f), synthetic_frames(1, frame_shape)[0])
+        m = Model(weights, imgsz=imgsz, device=device)
+        run = lambda: m.run(source=f, save_txt=False, nosave=True, project=d)
+
+        def per_request():
+            model = DetectMultiBackend(weights, device=m.device, data='coco128.yaml')
+            model.warmup(imgsz=(1, 3, *m.imgsz))
+            run()
+
+        before, after = timeit(per_request, n), timeit(run, n)
+    return [header(), summary('engine per request (before)', before), summary('persistent engine (after)', after),
+            f'per-call overhead removed: {before.mean() - after.mean():.1f}ms']
+
+
+def batching(weights, imgsz, device, n, frame_shape, cameras=4, **kwargs):
+    # Frames of several cameras inferred one by one vs. submitted concurrently to a Batcher
+    m = Model(weights, imgsz=imgsz, device=device)
+    frames = synthetic_frames(cameras, frame_shape)
+    batcher = Batcher(m, max_batch=cameras, max_wait_ms=10)
+    one_by_one = timeit(lambda: [m.infer([f]) for f in frames], n)
+    batched = timeit(lambda: [x.result() for x in [batcher.submit(f, str(i)) for i, f in enumerate(frames)]], n)
+    fps = lambda t: f'{cameras / t.mean() * 1E3:.1f} frames/s'
+    return [header(), summary(f'{cameras} cameras one by one', one_by_one),
+            summary(f'{cameras} cameras batched', batched),
+            f'throughput: {fps(one_by_one)} one by one, {fps(batched)} batched']
+
+
+def swap(weights, imgsz, device, n, frame_shape, **kwargs):
+    # Swap the weights n times while a camera keeps inferring, and its latency during the swaps
+    m = Model(weights, imgsz=imgsz, device=device)
+    frame = synthetic_frames(1, frame_shape)[0]
+    idle = timeit(lambda: m.infer([frame]), n)
+    stop, t = threading.Event(), []
+
+    def traffic():
+        while not stop.is_set():
+            t.append(timeit(lambda: m.infer([frame]), 1)[0])
+
+    thread = threading.Thread(target=traffic, daemon=True)
+    thread.start()
+    reports = [m.swap(weights, sample=frame) for _ in range(n)]
+    stop.set()
+    thread.join()
+    ready, swapped = (np.array([r[k] * 1E3 for r in reports]) for k in ('load_warmup_validate_s', 'swap_latency_s'))
+    peak = max(r['peak_rss_mb'] - r['rss_before_mb'] for r in reports)
+    return [header(), summary('load + warmup + validate', ready), summary('atomic engine swap', swapped),
+            summary('inference, idle', idle), summary('inference, during swaps', np.array(t)),
+            f'peak RSS growth during a swap: {peak:.1f}MB']
+
+
+def multiprocess(weights, imgsz, device, n, frame_shape, cameras=4, pool=2, **kwargs):
+    # Frames of several cameras inferred in the server process vs. submitted concurrently to a pinned worker pool
+    m = Model(weights, imgsz=imgsz, device=device)
+    frames = synthetic_frames(cameras, frame_shape)
+    in_process = timeit(lambda: [m.infer([f]) for f in frames], n)
+    p = WorkerPool(weights, pool, imgsz=imgsz, device=device)
+    pooled = timeit(lambda: [x.result() for x in [p.submit([f], [str(i)]) for i, f in enumerate(frames)]], n)
+    p.close()
+    fps = lambda t: f'{cameras / t.mean() * 1E3:.1f} frames/s'
+    return [header(), summary(f'{cameras} cameras in process', in_process),
+            summary(f'{cameras} cameras on {pool} workers {p.cores}', pooled),
+            f'throughput: {fps(in_process)} in process, {fps(pooled)} on {pool} workers']
+
+
+def startup(weights, imgsz, device, n, frame_shape, **kwargs):
+    # Model load from the checkpoint (load, float, fuse) vs. from the cached fused model, and the server's Model startup
+    attempt_load(weights, device=device)  # cache the fused model
+    before = timeit(lambda: attempt_load(weights, device=device, cache=False), n)
+    after = timeit(lambda: attempt_load(weights, device=device), n)
+    m = timeit(lambda: Model(weights, imgsz=imgsz, device=device), n)
+    return [header(), summary('checkpoint load + fuse (before)', before), summary('cached fused model (after)', after),
+            summary('Model startup incl. warmup (after)', m),
+            f'load time removed: {before.mean() - after.mean():.1f}ms']
+
+
+def warmup(weights, imgsz, device, n, frame_shape, cameras=4, **kwargs):
+    # Latency of the first requests of each camera shape and of a batch after startup, without vs. with warmup
+    shapes = [tuple(frame_shape[:2]), (720, 1280), (480, 640)]
+    frames = [f for shape in shapes for f in synthetic_frames(1, (*shape, 3))]
+    first = lambda m: [timeit(lambda: m.infer([f]), 1)[0] for f in frames] + [timeit(lambda: m.infer(frames), 1)[0]]
+    before, after, t = [], [], []
+    for _ in range(n):
+        before += first(Model(weights, imgsz=imgsz, device=device, frame_shapes=shapes, batch_sizes=(1, cameras)))
+        m = Model(weights, imgsz=imgsz, device=device, frame_shapes=shapes, batch_sizes=(1, cameras))
+        t.append(m.warmup() * 1E3)
+        after += first(m)
+    before, after = np.array(before), np.array(after)
+    return [header(), summary('first requests, no warmup (before)', before),
+            summary('first requests, warmed up (after)', after), summary('warmup', np.array(t)),
+            f'worst first request: {before.max():.1f}ms before, {after.max():.1f}ms after']
+
+
+def compiled(weights, imgsz, device, n, frame_shape, **kwargs):
+    # Frame latency of the PyTorch model in eager mode vs. compiled, and the compiled models' max output difference on
+    # two frames. Checks that compiled models follow their input, i.e. ensemble members traced on other threads do not
+    frames = synthetic_frames(2, frame_shape)
+    lines, y0 = [header()], None
+    for mode in 'eager', 'torchscript', 'compile':
+        t = time.perf_counter()
+        m = Model(weights, imgsz=imgsz, device=device, pt_options={'mode': mode})
+        y = []
+        for f in frames:
+            with torch.inference_mode(), Model._preprocess([f], m.imgsz, m.model) as im:
+                y.append(m.model(im)[0])  # the first frame compiles
+        t = time.perf_counter() - t
+        y0 = y0 or y
+        diff = max(float((a - b).abs().max()) for a, b in zip(y, y0))
+        change = float((y0[1] - y0[0]).abs().max())  # eager output change between the frames
+        assert diff < change / 2, f'{mode} output does not follow the input, diff {diff:.0e} vs. eager {change:.0e}'
+        name = f'{mode} ({t:.1f}s load, diff {diff:.0e})'
+        lines.append(summary(name, timeit(lambda: m.infer([frames[0]]), n)))
+    return lines
+
+
+def precision(weights, imgsz, device, n, frame_shape, source=None, **kwargs):
+    # Frame latency of the PyTorch model in fp32 vs. channels-last and bfloat16, and their accuracy against fp32: mAP
+    # with the fp32 detections (conf>0.25) as labels on captured frames of source, and max output difference
+    frames = [cv2.imread(f) for f in sample_frames(source, n)] if source else synthetic_frames(n, frame_shape)
+    options = {'fp32': {}, 'channels-last': {'channels_last': True}, 'bf16': {'bf16': True},
+               'channels-last + bf16': {'channels_last': True, 'bf16': True}}
+    lines, y0, labels = [header() + f"{'mAP50':>8s}{'mAP50-95':>10s}{'max diff':>10s}"], None, None
+    for name, pt_options in options.items():
+        m = Model(weights, imgsz=imgsz, device=device, pt_options=pt_options)
+        y = []
+        for f in frames:
+            with torch.inference_mode(), Model._preprocess([f], m.imgsz, m.model) as im:
+                y.append(m.model(im)[0])
+        y0 = y0 or y
+        labels = labels or [non_max_suppression(x, 0.25, 0.45)[0] for x in y]
+        _, _, ap50, ap, _ = detections_ap([non_max_suppression(x, 0.001, 0.6)[0] for x in y], labels, m.names)
+        ap = f'{ap50.mean():>8.3f}{ap.mean():>10.3f}' if len(ap) else f"{'-':>8s}{'-':>10s}"  # no labels
+        diff = max(float((a - b).abs().max()) for a, b in zip(y, y0))
+        lines.append(summary(name, timeit(lambda: m.infer([frames[0]]), n)) + f'{ap}{diff:>10.1e}')
+    return lines
+
+
+def threads(weights, imgsz, device, n, frame_shape, cameras=4, **kwargs):
+    # Frame latency and throughput of several cameras inferring concurrently (as Flask request threads) over intra-op
+    # thread counts up to oversubscription, with inferences unbounded vs. one at a time (THREADS concurrency)
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    counts = sorted({2 ** i for i in range(cores.bit_length())} | {cores, 2 * cores})
+    frame = synthetic_frames(1, frame_shape)[0]
+    lines, results = [header() + f"{'frames/s':>10s}"], {}
+    with ThreadPoolExecutor(cameras) as pool:
+        for t in counts:
+            for concurrency in 0, 1:
+                policy = set_threads(intra_op=t, concurrency=concurrency)
+                m = Model(weights, imgsz=imgsz, device=device, thread_options=policy)
+                t0 = time.perf_counter()
+                lat = np.concatenate(list(pool.map(lambda _: timeit(lambda: m.infer([frame]), n), range(cameras))))
+                name = f"{t} threads, {'1 inference' if concurrency else f'{cameras} inferences'} at once"
+                results[name] = np.percentile(lat, 95), len(lat) / (time.perf_counter() - t0)
+                lines.append(summary(name, lat) + f'{results[name][1]:>10.1f}')
+    set_threads()  # restore the default policy
+    lines.append(f'{cores} cores, {cameras} cameras. Best p95 latency: {min(results, key=lambda k: results[k][0])}, '
+                 f'best throughput: {max(results, key=lambda k: results[k][1])}')
+    return lines
+
+
+def augment(weights, imgsz, device, n, frame_shape, **kwargs):
+    # Frame latency without augmentation vs. augmented inference, a forward per augmentation vs. two forwards
+    m = Model(weights, imgsz=imgsz, device=device)
+    frame = synthetic_frames(1, frame_shape)[0]
+    lines = [header()]
+    for name, aug in ('no augmentation', False), ('augmented, looped', True), ('augmented, batched', 'batched'):
+        m.infer([frame], augment=aug)  # warmup
+        lines.append(summary(name, timeit(lambda: m.infer([frame], augment=aug), n)))
+    return lines
+
+
+def memory(weights, imgsz, device, n, frame_shape, cameras=4, pool=2, **kwargs):
+    # Memory per worker of a worker pool after inferring frames of several cameras, each worker with its private copy
+    # of the weights vs. the cached fused weights memory-mapped by every worker. RSS counts the shared pages in every
+    # worker, PSS splits them among the workers and USS counts the private pages only
+    frames = synthetic_frames(cameras, frame_shape)
+    attempt_load(weights, device=device)  # cache the fused model
+    lines, uss = [f"{'Workers':<40s}{'RSS':>10s}{'PSS':>10s}{'USS':>10s}"], {}
+    for name, mmap in ('private weights (before)', False), ('memory-mapped weights (after)', True):
+        p = WorkerPool(weights, pool, imgsz=imgsz, device=device, pt_options={'mmap': mmap})
+        for _ in range(n):
+            [x.result() for x in [p.submit([f], [str(i)]) for i, f in enumerate(frames)]]
+        mem = p.memory()
+        p.close()
+        for k, m in enumerate(mem):
+            mb = ''.join(f'{m[x]:>8.1f}MB' for x in ('rss_mb', 'pss_mb', 'uss_mb'))
+            lines.append(f"{f'{name} worker {k}':<40s}{mb}")
+        uss[name] = sum(m['uss_mb'] for m in mem) / len(mem)
+    before, after = uss.values()
+    lines.append(f'{pool} workers, weights {os.path.getsize(weights) / (1 << 20):.1f}MB. '
+                 f'Private memory per worker: {before:.1f}MB before, {after:.1f}MB after')
+    return lines
+
+
+def preprocess(weights, imgsz, device, n, frame_shape, cameras=4, **kwargs):
+    # Latency of frames to a normalized RGB batch tensor at inference sizes 640 and 1280, one frame and a frame per
+    # camera: letterbox, transpose, contiguous copy, float, normalization and concatenation vs. the letterbox plan and
+    # single-pass conversion into a pooled input slab
+    m = Model(weights, imgsz=imgsz, device=device)
+    stride, auto = m.model.stride, m.model.pt
+
+    def chain(frames, size):
+        ims = []
+        for im0 in frames:
+            im = letterbox(im0, size, stride=stride, auto=auto)[0]
+            im = torch.from_numpy(np.ascontiguousarray(im.transpose((2, 0, 1))[::-1])).float()
+            im /= 255
+            ims.append(im[None])
+        return torch.cat(ims)
+
+    def single_pass(frames, size):
+        with Model._preprocess(frames, (size, size), m.model) as im:
+            return im
+
+    lines = [header()]
+    for size in 640, 1280:
+        for b in sorted({1, cameras}):
+            frames = synthetic_frames(b, frame_shape)
+            assert torch.equal(chain(frames, size), single_pass(frames, size))
+            lines += [summary(f'{size} x {b} frames, chain (before)', timeit(lambda: chain(frames, size), n)),
+                      summary(f'{size} x {b} frames, single pass (after)',
+                              timeit(lambda: single_pass(frames, size), n))]
+    return lines
+
+
+def codec(weights, imgsz, device, n, frame_shape, source=None, **kwargs):
+    # JPEG encode, decode and 1/2 resolution decode latency and file size of camera frame shapes, OpenCV defaults vs.
+    # every installed codec backend over qualities and chroma subsamplings. Captured frames of source if given, else
+    # smooth synthetic frames (random noise is not representative of JPEG cost)
+    im = cv2.imread(sample_frames(source, 1)[0]) if source else \
+        cv2.resize(synthetic_frames(1, (frame_shape[0] // 16, frame_shape[1] // 16, 3))[0], frame_shape[1::-1])
+    backends = {Codec(b).backend for b in BACKENDS[1:]}  # installed ones
+    lines = [f"{'':<40s}{'encode ms':>10s}{'decode ms':>10s}{'1/2 ms':>10s}{'KB':>10s}"]
+    for shape in dict.fromkeys([tuple(frame_shape[:2]), (720, 1280), (480, 640)]):
+        frame = cv2.resize(im, shape[::-1], interpolation=cv2.INTER_AREA)
+        buf = cv2.imencode('.jpg', frame)[1]
+        t = [timeit(fn, n).mean() for fn in (lambda: cv2.imencode('.jpg', frame), lambda: cv2.imdecode(buf, 1),
+                                             lambda: cv2.imdecode(buf, cv2.IMREAD_REDUCED_COLOR_2))]
+        lines.append(f"{f'{shape[1]}x{shape[0]} OpenCV defaults (before)':<40s}{t[0]:>10.2f}{t[1]:>10.2f}{t[2]:>10.2f}"
+                     f'{len(buf) / 1E3:>10.1f}')
+        for b in sorted(backends):
+            for quality, subsampling in (95, '420'), (90, '420'), (95, '444'):
+                c = Codec(b, quality, subsampling)
+                buf = c.encode(frame)
+                t = [timeit(fn, n).mean() for fn in (lambda: c.encode(frame), lambda: c.decode(buf),
+                                                     lambda: c.decode(buf, 2))]
+                name = f'{shape[1]}x{shape[0]} {b} q{quality} {subsampling}'
+                lines.append(f'{name:<40s}{t[0]:>10.2f}{t[1]:>10.2f}{t[2]:>10.2f}{len(buf) / 1E3:>10.1f}')
+    return lines
+
+
+def models(weights, imgsz, device, n, frame_shape, **kwargs):
+    # Camera model cache with site weights and ensemble weights (weights as a list), each also copied to another path:
+    # latency of a camera's request while its model loads (served by the default model) and once it is cached. Checks
+    # that cameras with identical weights files share one model, single or ensemble
+    weights = weights if isinstance(weights, list) else [weights] * 2
+    frame = synthetic_frames(1, frame_shape)[0]
+    with tempfile.TemporaryDirectory() as d:
+        copies = [shutil.copy(w, Path(d) / f'{i}_{Path(w).name}') for i, w in enumerate(weights)]  # same content
+        default = Model(weights[0], imgsz=imgsz, device=device)
+        manager = ModelManager(default, {'site': copies[0], 'ensemble': weights, 'ensemble copy': copies},
+                               max_mb=1 << 20, imgsz=imgsz, device=device)
+        assert manager.get('site') is default, 'site weights identical to the default weights not shared'
+        t = time.perf_counter()
+        loading = timeit(lambda: manager.get('ensemble').infer([frame]), 1)  # starts the load
+        model = manager.get('ensemble', wait=True)
+        t = time.perf_counter() - t
+        assert model is not default and manager.get('ensemble copy') is model, 'identical ensemble weights not shared'
+        cached = timeit(lambda: manager.get('ensemble copy').infer([frame]), n)
+        info = manager.info()
+    return [header(), summary('ensemble camera, model loading', loading), summary('ensemble camera, cached', cached),
+            f"ensemble load {t:.1f}s, {len(info['models'])} cached model(s) {info['mb']}MB for 3 cameras"]
+
+
+def run(
+        weights=ROOT / 'best.pt',  # model.pt path(s), several for an ensemble
+        imgsz=(640, 640),  # inference size (height, width)
+        device='cpu',  # cuda device, i.e. 0 or 0,1,2,3 or cpu
+        task='engine',  # benchmark to run
+        n=20,  # timed iterations
+        frame_shape=(1080, 1920, 3),  # synthetic camera frame shape (h, w, c)
+        cameras=4,  # number of concurrent cameras
+        workers=2,  # number of worker processes
+        source=None,  # captured frames directory for accuracy checks, synthetic frames if None
+):
+    assert task in TASKS, f'ERROR: Invalid --task {task}, valid --task arguments are {TASKS}'
+    weights = [str(w) for w in weights] if isinstance(weights, (list, tuple)) else [str(weights)]
+    weights = weights[0] if len(weights) == 1 else weights  # several weights for an ensemble
+    imgsz *= 2 if len(imgsz) == 1 else 1  # expand
+    tasks = {'engine': engine, 'batching': batching, 'swap': swap, 'workers': multiprocess, 'startup': startup,
+             'warmup': warmup, 'compile': compiled, 'precision': precision, 'threads': threads,
+             'augment': augment, 'memory': memory, 'preprocess': preprocess,
+             'codec': codec, 'models': models}
+    lines = tasks[task](weights, imgsz, device, n, tuple(frame_shape), cameras=cameras, pool=workers,
+                        source=source)
+    LOGGER.info(f"\n{colorstr('Benchmark:')} {task} ({n} iterations, frame {frame_shape})\n" + '\n'.join(lines))
+    return lines
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--weights', nargs='+', type=str, default=ROOT / 'best.pt', help='model.pt path(s), ensemble')
+    parser.add_argument('--imgsz', '--img', '--img-size', nargs='+', type=int, default=[640, 640], help='image (h, w)')
+    parser.add_argument('--device', default='cpu', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
+    parser.add_argument('--task', default='engine', help=', '.join(TASKS))
+    parser.add_argument('--n', type=int, default=20, help='timed iterations')
+    parser.add_argument('--frame-shape', nargs=3, type=int, default=[1080, 1920, 3], help='camera frame (h, w, c)')
+    parser.add_argument('--cameras', type=int, default=4, help='number of concurrent cameras')
+    parser.add_argument('--workers', type=int, default=2, help='number of worker processes')
+    parser.add_argument('--source', type=str, default=None, help='captured frames directory for accuracy checks')
+    opt = parser.parse_args()
+    print_args(vars(opt))
+    return opt
+
+
+def main(opt):
+    run(**vars(opt))
+
+
+if __name__ == "__main__":
+    opt = parse_opt()
+    main(opt)
@@ -52,9 +52,112 @@ FETCH = ['last', 'all']
 # Truck classes
 CLASS_NAME = {0: 'uncovered', 1: 'covered', 2: 'other'}
 
+# Model's weights. A list of weights, i.e. ['best.pt', 'best2.pt'], runs an ensemble of the models concurrently
+WEIGHTS = 'best.pt'
+
+# Site-specific weights of cameras, i.e. {'EVLAIM_CAM': 'evlaim.pt'}. Cameras not listed are inferred with WEIGHTS
+CAMERA_WEIGHTS = {}
+
+# Maximum memory (MiB) of the loaded site-specific models. The least recently used models are evicted beyond it
+MODEL_CACHE_MB = 1024
+
+# Merge of the detections of an ensemble of weights: 'nms' over all the models' boxes or 'wbf' weighted boxes fusion
+ENSEMBLE_MERGE = 'wbf'
+
+# Inference size (height, width)
+IMG_SIZE = (640, 640)
+
+# Frame shapes (height, width) of the cameras, i.e. [(1080, 1920), (720, 1280)], to precompute the model's grids for
+FRAME_SHAPES = []
+
+# Batch sizes to warm up on every frame shape before the server is ready, i.e. [1, MAX_BATCH] when BATCHING
+WARMUP_BATCH_SIZES = [1]
+
+# Threading policy of the server process (and of the worker processes, with WORKER_THREADS intra-op threads), applied
+# to PyTorch, ONNX Runtime, OpenVINO and OpenCV. Flask serves every request on its own thread, concurrency bounds the
+# inferences running at once so their intra-op threads do not oversubscribe the cores. See benchmarks.py --task threads
+THREADS = {
+    'intra_op': 0,  # threads within an operator. 0 uses one thread per CPU core
+    'inter_op': 0,  # threads across operators. 0 keeps the runtimes' defaults
+    'opencv': 0,  # OpenCV preprocessing threads. 0 disables OpenCV multithreading
+    'concurrency': 1  # inferences running at once per process. 0 is unbounded
+}
+
+# PyTorch options for *.pt weights
+PT_OPTIONS = {
+    'mode': 'eager',  # eager, torchscript (trace, freeze and optimize_for_inference) or compile (torch.compile)
+    'cache': True,  # cache compiled models on disk, per input shape
+    'channels_last': False,  # channels-last (NHWC) memory format of the model and input
+    'bf16': False,  # CPU bfloat16 autocast, on CPUs supporting it (AVX512-BF16/AMX)
+    'mmap': True  # memory-map the cached fused weights, shared by the worker processes. Not with channels_last/fp16
+}
+
+# ONNX Runtime session options for *.onnx weights
+ONNX_SESSION_OPTIONS = {
+    'graph_optimization_level': 'all',  # disable, basic, extended or all
+    'intra_op_num_threads': 0,  # threads within an operator. 0 follows THREADS
+    'inter_op_num_threads': 0,  # threads across operators in parallel execution mode. 0 follows THREADS
+    'execution_mode': 'sequential',  # sequential or parallel
+    'enable_cpu_mem_arena': True,  # reuse CPU memory across inferences
+    'optimized_model_filepath': '',  # cache of the optimized model, i.e. 'best_optimized.onnx'. '' disables the cache
+    'io_binding': False  # bind preallocated input and output buffers, pooled per input shape
+}
+
+# OpenVINO options for *_openvino_model weights
+OPENVINO_OPTIONS = {
+    'performance_hint': 'THROUGHPUT',  # LATENCY or THROUGHPUT (frames of different cameras inferred in parallel)
+    'num_streams': 'AUTO',  # parallel inference streams, i.e. 4. 'AUTO' lets OpenVINO choose
+    'num_requests': 0,  # async infer requests in THROUGHPUT mode. 0 uses the optimal number for the streams
+    'timeout': 30  # seconds to wait for an async infer request's output before failing the request. None waits forever
+}
+
+# Backend selection at startup among WEIGHTS and its exports (i.e. best.onnx): None, 'p95' or 'throughput'
+BACKEND_POLICY = None
+
+# Number of frames (the latest of INPUT_FOLDER, or synthetic) to benchmark each backend on
+BACKEND_BENCHMARK_FRAMES = 20
+
+# Maximum mAP50-95 drop of an INT8 export (i.e. best_int8.onnx) vs. FP32 in its export.py --int8 report, i.e. 0.02, for
+# the backend selection to consider it. None never selects INT8 exports
+BACKEND_INT8_MAX_MAP_DROP = None
+
+# Interval (seconds) for checking the weights file for changes and swapping it in. 0 disables watching
+WEIGHTS_WATCH_INTERVAL_SECONDS = 10
+
+# Directory of the weights that POST /admin/swap_model may swap in, by file name (weights=best_v2.pt)
+SWAP_WEIGHTS_DIR = '.'
+
 # Inference threshold
 CONF_THRES = 0.25
 
+# Micro-batching of frames from concurrent requests (i.e. several cameras) into one batched forward
+BATCHING = False
+
+# Maximum number of frames in a batch
+MAX_BATCH = 8
+
+# Maximum time (milliseconds) the first frame of a batch waits for more frames
+MAX_WAIT_MS = 10
+
+# Number of inference worker processes, each pinned to its own CPU cores. 0 infers in the server process
+WORKERS = 0
+
+# Intra-op threads per inference worker process. None uses one thread per pinned core
+WORKER_THREADS = None
+
+# Save each inferred input frame into INPUT_FOLDER
+SAVE_INPUT_FRAMES = True
+
+# Save each inferred frame's label and annotated image into OUTPUT_FOLDER
+SAVE_OUTPUT_FRAMES = True
+
+# Codec of the saved and read frames, JPEGs by a libjpeg-turbo binding (PyTurboJPEG or simplejpeg) if installed
+IMAGE_CODEC = {
+    'backend': 'auto',  # auto, turbojpeg, simplejpeg or opencv
+    'quality': 95,  # JPEG quality (0-100)
+    'subsampling': '420'  # JPEG chroma subsampling: 444, 422 or 420
+}
+
 # Serial max number - 7 digits
 MAX_SERIAL_NUM = 9999999
 
@@ -54,8 +54,10 @@ import subprocess
 import sys
 import time
 import warnings
+from copy import deepcopy
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 import torch
 from torch.utils.mobile_optimizer import optimize_for_mobile
@@ -67,11 +69,14 @@ if str(ROOT) not in sys.path:
 if platform.system() != 'Windows':
     ROOT = Path(os.path.relpath(ROOT, Path.cwd()))  # relative
 
+from models.common import DetectMultiBackend
 from models.experimental import attempt_load
 from models.yolo import ClassificationModel, Detect, DetectionModel, SegmentationModel
-from utils.dataloaders import LoadImages
+from utils.dataloaders import IMG_FORMATS, LoadImages
 from utils.general import (LOGGER, Profile, check_dataset, check_img_size, check_requirements, check_version,
-                           check_yaml, colorstr, file_size, get_default_args, print_args, url2file, yaml_save)
+                           check_yaml, colorstr, file_size, get_default_args, non_max_suppression, print_args,
+                           url2file, yaml_save)
+from utils.metrics import detections_ap
 from utils.torch_utils import select_device, smart_inference_mode
 
 MACOS = platform.system() == 'Darwin'  # macOS environment
@@ -129,6 +134,42 @@ def export_torchscript(model, im, file, optimize, prefix=colorstr('TorchScript:'
     return f, None
 
 
+@try_export
+def export_torchscript_int8(model, im, file, source, n=100, prefix=colorstr('TorchScript INT8:')):
+    # YOLOv5 TorchScript INT8 export: FX graph mode static post-training quantization of the Conv/C3/SPPF blocks,
+    # calibrated on captured frames, Detect() kept in FP32. Runs on the PyTorch quantized CPU kernels
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.fx.custom_config import PrepareCustomConfig
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+    assert im.device.type == 'cpu', 'TorchScript INT8 export requires --device cpu'
+    engine = torch.backends.quantized.engine  # x86 on x86-64 CPUs
+    LOGGER.info(f'\n{prefix} starting export with torch {torch.__version__} ({engine} engine)...')
+    f = Path(str(file).replace('.pt', '_int8.torchscript'))
+
+    class Body(torch.nn.Module):
+        # Model forward without the augment/profile/visualize arguments, symbolically traceable
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self, x):
+            return self.model._forward_once(x)
+
+    qconfig_mapping = get_default_qconfig_mapping(engine).set_object_type(Detect, None)  # FP32 Detect()
+    custom_config = PrepareCustomConfig().set_non_traceable_module_classes([Detect])  # input shape dependent grids
+    model_q = prepare_fx(Body(deepcopy(model)).eval(), qconfig_mapping, (im,), prepare_custom_config=custom_config)
+    stride = int(max(model.stride))
+    for _, x, *_ in LoadImages(sample_frames(source, n), img_size=im.shape[2:], stride=stride, auto=False):
+        model_q(torch.from_numpy(x)[None].float() / 255)  # calibrate
+    model_q = convert_fx(model_q)
+
+    ts = torch.jit.freeze(torch.jit.trace(model_q, im, strict=False).eval())
+    d = {"shape": im.shape, "stride": stride, "names": model.names, "qengine": engine}
+    ts.save(str(f), _extra_files={'config.txt': json.dumps(d)})
+    return f, None
+
+
 @try_export
 def export_onnx(model, im, file, opset, dynamic, simplify, prefix=colorstr('ONNX:')):
     # YOLOv5 ONNX export
@@ -185,6 +226,121 @@ def export_onnx(model, im, file, opset, dynamic, simplify, prefix=colorstr('ONNX
     return f, model_onnx
 
 
+def sample_frames(source, n=100, exclude=()):
+    # Paths of n captured frames evenly spaced in the source directory, leaving out the exclude paths
+    exclude = set(exclude)
+    files = sorted(str(x) for x in Path(source).glob('*.*') if x.suffix[1:].lower() in IMG_FORMATS)
+    files = [x for x in files if x not in exclude]
+    assert files or exclude, f'No images found in {source}'
+    if len(files) < n:
+        LOGGER.warning(f"WARNING ⚠️ {len(files)} frames{' not used for calibration' if exclude else ''} in {source}, "
+                       f'fewer than the {n} requested')
+    n = min(n, len(files))
+    return [files[int(i * len(files) / n)] for i in range(n)]
+
+
+@try_export
+def export_onnx_int8(file, imgsz, stride, source, n=100, prefix=colorstr('ONNX INT8:')):
+    # YOLOv5 ONNX INT8 static post-training quantization, calibrated on captured frames
+    check_requirements('onnxruntime')
+    import onnxruntime
+    from onnxruntime.quantization import (CalibrationDataReader, CalibrationMethod, QuantFormat, QuantType,
+                                          quantize_static)
+
+    LOGGER.info(f'\n{prefix} starting export with onnxruntime {onnxruntime.__version__}...')
+    f_onnx = file.with_suffix('.onnx')
+    f = Path(str(file).replace('.pt', '_int8.onnx'))
+
+    class Frames(CalibrationDataReader):
+        # Letterboxed calibration frames in the FP32 model input format
+        def __init__(self):
+            self.dataset = iter(LoadImages(sample_frames(source, n), img_size=imgsz, stride=stride, auto=False))
+
+        def get_next(self):
+            _, im, *_ = next(self.dataset, (None, None))
+            return None if im is None else {'images': (im[None] / 255).astype(np.float32)}
+
+    quantize_static(f_onnx,
+                    f,
+                    Frames(),
+                    quant_format=QuantFormat.QDQ,
+                    per_channel=True,
+                    activation_type=QuantType.QUInt8,
+                    weight_type=QuantType.QInt8,
+                    nodes_to_exclude=onnx_head_nodes(f_onnx),
+                    calibrate_method=CalibrationMethod.MinMax)
+    return f, None
+
+
+def onnx_head_nodes(f):
+    # Names of the ONNX nodes decoding the Detect() outputs (after the output convolutions), kept in FP32
+    import onnx
+
+    graph = onnx.load(f, load_external_data=False).graph
+    consumers = {}
+    for node in graph.node:
+        for x in node.input:
+            consumers.setdefault(x, []).append(node)
+    heads = [n for n in graph.node if n.op_type == 'Conv' and
+             any(c.op_type == 'Reshape' for c in consumers.get(n.output[0], []))]  # Detect() m convolutions
+    names, stack = set(), [x for n in heads for x in n.output]
+    while stack:
+        for node in consumers.get(stack.pop(), []):
+            if node.name not in names:
+                names.add(node.name)
+                stack.extend(node.output)
+    return sorted(names)
+
+
+@smart_inference_mode()
+def int8_report(weights, f, source, imgsz, stride, n=100, conf_thres=0.25, prefix=colorstr('INT8 report:')):
+    # Detections and CPU latency of the INT8 model (ONNX or TorchScript) vs. the FP32 PyTorch model, and vs. the FP32
+    # ONNX model, on held-out captured frames
+    ref = DetectMultiBackend(weights, device=torch.device('cpu'))
+    fmt = 'ONNX' if Path(f).suffix == '.onnx' else 'TorchScript'
+    models = {'FP32 ONNX': DetectMultiBackend(Path(weights).with_suffix('.onnx'))} if fmt == 'ONNX' else {}
+    models[f'INT8 {fmt}'] = DetectMultiBackend(f)
+    names = ref.names
+    frames = sample_frames(source, n, exclude=sample_frames(source, n))  # disjoint from the calibration frames
+    if not frames:
+        LOGGER.warning(f'{prefix} WARNING ⚠️ no held-out frames left in {source}, skipping report. Capture more frames '
+                       f'or lower --calib-images')
+        return None
+    t = {k: Profile() for k in ('FP32 PyTorch', *models)}
+    dets = {k: [] for k in t}
+    for _, im, *_ in LoadImages(frames, img_size=imgsz, stride=stride, auto=False):
+        im = torch.from_numpy(im)[None].float() / 255
+        for k, model in (('FP32 PyTorch', ref), *models.items()):
+            with t[k]:
+                y = model(im)
+            dets[k].append(non_max_suppression(y, conf_thres if model is ref else 0.001, 0.6, max_det=300)[0])
+
+    # Report
+    s = f"{'Model':<17s}{'Class':>12s}{'Instances':>11s}{'P':>8s}{'R':>8s}{'mAP50':>8s}{'mAP50-95':>10s}{'ms':>8s}"
+    lines = [f'{prefix} {len(frames)} frames from {source}, FP32 PyTorch detections (conf>{conf_thres}) as labels', s]
+    nt = np.bincount(torch.cat(dets['FP32 PyTorch'])[:, 5].int().numpy(), minlength=len(names))
+    for k in models:
+        ms = t[k].t / len(frames) * 1E3
+        if not nt.sum():  # no FP32 reference detections to score against
+            lines.append(f"{k:<17s}{'all':>12s}{0:>11d}{'n/a':>8s}{'n/a':>8s}{'n/a':>8s}{'n/a':>10s}{ms:>8.1f}")
+            continue
+        p, r, ap50, ap, ap_class = detections_ap(dets[k], dets['FP32 PyTorch'], names)
+        lines.append(f"{k:<17s}{'all':>12s}{nt.sum():>11d}{p.mean() if len(p) else 0:>8.3g}"
+                     f"{r.mean() if len(r) else 0:>8.3g}{ap50.mean() if len(ap) else 0:>8.3g}"
+                     f"{ap.mean() if len(ap) else 0:>10.3g}{ms:>8.1f}")
+        for i, c in enumerate(ap_class):
+            lines.append(f'{k:<17s}{names[c]:>12s}{nt[c]:>11d}{p[i]:>8.3g}{r[i]:>8.3g}{ap50[i]:>8.3g}{ap[i]:>10.3g}')
+    ms = t['FP32 PyTorch'].t / len(frames) * 1E3
+    lines.append(f"{'FP32 PyTorch':<17s}{'all':>12s}{nt.sum():>11d}{'':>34s}{ms:>8.1f}")
+    s = f"INT8 speedup: {t['FP32 PyTorch'].t / t[f'INT8 {fmt}'].t:.2f}x vs. FP32 PyTorch"
+    lines.append(s + (f", {t['FP32 ONNX'].t / t['INT8 ONNX'].t:.2f}x vs. FP32 ONNX" if fmt == 'ONNX' else ''))
+
+    f_report = Path(str(f).replace('.onnx', '_report.txt').replace('.torchscript', '_torchscript_report.txt'))
+    f_report.write_text('\n'.join(lines) + '\n')
+    LOGGER.info('\n' + '\n'.join(lines) + f'\n{prefix} saved as {f_report}')
+    return f_report
+
+
 @try_export
 def export_openvino(file, metadata, half, prefix=colorstr('OpenVINO:')):
     # YOLOv5 OpenVINO export
@@ -499,7 +655,7 @@ def run(
         inplace=False,  # set YOLOv5 Detect() inplace=True
         keras=False,  # use Keras
         optimize=False,  # TorchScript: optimize for mobile
-        int8=False,  # CoreML/TF INT8 quantization
+        int8=False,  # CoreML/TF/TorchScript/ONNX INT8 quantization
         dynamic=False,  # ONNX/TF/TensorRT: dynamic axes
         simplify=False,  # ONNX: simplify model
         opset=12,  # ONNX: opset version
@@ -511,6 +667,8 @@ def run(
         topk_all=100,  # TF.js NMS: topk for all classes to keep
         iou_thres=0.45,  # TF.js NMS: IoU threshold
         conf_thres=0.25,  # TF.js NMS: confidence threshold
+        calib_data=ROOT / 'input_data',  # TorchScript/ONNX INT8: calibration frames directory
+        calib_images=100,  # TorchScript/ONNX INT8: number of calibration frames
 ):
     t = time.time()
     include = [x.lower() for x in include]  # to lowercase
@@ -558,10 +716,20 @@ def run(
     warnings.filterwarnings(action='ignore', category=torch.jit.TracerWarning)  # suppress TracerWarning
     if jit:  # TorchScript
         f[0], _ = export_torchscript(model, im, file, optimize)
+        if int8:  # TorchScript INT8
+            f_int8, _ = export_torchscript_int8(model, im, file, calib_data, calib_images)
+            if f_int8:
+                f[0] = f_int8
+                int8_report(file, f_int8, calib_data, imgsz, gs, calib_images)
     if engine:  # TensorRT required before ONNX
         f[1], _ = export_engine(model, im, file, half, dynamic, simplify, workspace, verbose)
     if onnx or xml:  # OpenVINO requires ONNX
         f[2], _ = export_onnx(model, im, file, opset, dynamic, simplify)
+        if int8 and onnx:  # ONNX INT8
+            f_int8, _ = export_onnx_int8(file, imgsz, gs, calib_data, calib_images)
+            if f_int8:
+                f[2] = f_int8
+                int8_report(file, f_int8, calib_data, imgsz, gs, calib_images)
     if xml:  # OpenVINO
         f[3], _ = export_openvino(file, metadata, half)
     if coreml:  # CoreML
@@ -620,7 +788,7 @@ def parse_opt():
     parser.add_argument('--inplace', action='store_true', help='set YOLOv5 Detect() inplace=True')
     parser.add_argument('--keras', action='store_true', help='TF: use Keras')
     parser.add_argument('--optimize', action='store_true', help='TorchScript: optimize for mobile')
-    parser.add_argument('--int8', action='store_true', help='CoreML/TF INT8 quantization')
+    parser.add_argument('--int8', action='store_true', help='CoreML/TF/TorchScript/ONNX INT8 quantization')
     parser.add_argument('--dynamic', action='store_true', help='ONNX/TF/TensorRT: dynamic axes')
     parser.add_argument('--simplify', action='store_true', help='ONNX: simplify model')
     parser.add_argument('--opset', type=int, default=12, help='ONNX: opset version')
@@ -632,6 +800,8 @@ def parse_opt():
     parser.add_argument('--topk-all', type=int, default=100, help='TF.js NMS: topk for all classes to keep')
     parser.add_argument('--iou-thres', type=float, default=0.45, help='TF.js NMS: IoU threshold')
     parser.add_argument('--conf-thres', type=float, default=0.25, help='TF.js NMS: confidence threshold')
+    parser.add_argument('--calib-data', type=str, default=ROOT / 'input_data', help='INT8: calibration frames')
+    parser.add_argument('--calib-images', type=int, default=100, help='INT8: number of calibration frames')
     parser.add_argument(
         '--include',
         nargs='+',
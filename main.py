@@ -2,10 +2,17 @@ from config import *
 from files import *
 from scraper import *
 from model import *
+from model_manager import *
+from batcher import *
+from worker_pool import *
 
 from flask import Flask, request
 from flask_apscheduler import APScheduler
+from utils import threaded
+from utils.codec import CODEC
+from utils.general import set_threads
 
+import copy
 import json
 import time
 
@@ -23,13 +30,69 @@ logger = Files('waste_reduction.log').set_logger()
 s3 = Files(s3_bucket=BUCKET, aws_access_key_id=AWS_ACCESS_KEY_ID, aws_secret_access_key=AWS_SECRET_ACCESS_KEY)
 
 # Scraper instance
-s = Scraper(CAMERA['TEL_ARAD_CAM'], MAX_SERIAL_NUM)
+camera = 'TEL_ARAD_CAM'
+s = Scraper(CAMERA[camera], MAX_SERIAL_NUM)
 
 # Continue counter from last serial number
 s.reset_counter(len(os.listdir(INPUT_FOLDER)))
 
-# Model instance
-m = Model('best.pt')
+# Threading policy of the server process, applied before any inference
+threads = set_threads(**THREADS)
+
+# Image codec of the saved and read frames
+CODEC.configure(**IMAGE_CODEC)
+logger.info(f'Image codec: {CODEC}')
+
+# Model arguments, shared by the model and the worker pool
+model_kwargs = dict(imgsz=IMG_SIZE, frame_shapes=FRAME_SHAPES, batch_sizes=WARMUP_BATCH_SIZES, merge=ENSEMBLE_MERGE,
+                    pt_options=PT_OPTIONS, onnx_options=ONNX_SESSION_OPTIONS, openvino_options=OPENVINO_OPTIONS,
+                    thread_options=threads)
+
+# Model instance, of the fastest backend among the weights and their exports if BACKEND_POLICY is set
+if BACKEND_POLICY:
+    files = sorted(os.listdir(INPUT_FOLDER))[-BACKEND_BENCHMARK_FRAMES:]  # latest frames
+    frames = [f for f in (CODEC.imread(os.path.join(INPUT_FOLDER, x)) for x in files) if f is not None]
+    m = Model.select(WEIGHTS, BACKEND_POLICY, frames, BACKEND_BENCHMARK_FRAMES,
+                     int8_max_map_drop=BACKEND_INT8_MAX_MAP_DROP, **model_kwargs)
+else:
+    m = Model(WEIGHTS, **model_kwargs)
+
+# Readiness status, degraded if warming up failed
+degraded = False
+
+
+@threaded
+def warmup():
+    """
+    Warming up the model on a thread. The server is ready once every frame shape and batch size was inferred, or ready
+    and degraded if warming up failed, its first requests paying for the warmup.
+    """
+    global degraded
+    try:
+        m.warmup()
+    except Exception:
+        logger.exception('Warming up failed, the server is ready but degraded')
+        degraded = True
+        m.ready = True
+
+
+# Warm up the model in the background
+warmup()
+
+# Batcher instance for micro-batching frames of concurrent requests
+b = Batcher(m, MAX_BATCH, MAX_WAIT_MS, conf_thres=CONF_THRES) if BATCHING else None
+
+# Worker pool instance for inferring in several processes pinned to their own CPU cores
+p = WorkerPool(m.weights, WORKERS, WORKER_THREADS, **model_kwargs) if WORKERS else None
+
+# Swap in the weights whenever the weights file is replaced. Swaps only reach the in-process engine, not the workers
+if WEIGHTS_WATCH_INTERVAL_SECONDS and p is None:
+    m.watch(WEIGHTS_WATCH_INTERVAL_SECONDS)
+elif WEIGHTS_WATCH_INTERVAL_SECONDS:
+    logger.warning('Not watching the weights file, swaps are not supported while the worker pool serves requests')
+
+# Model manager of the cameras' site-specific weights, loaded on first use and evicted least recently used
+models = ModelManager(m, CAMERA_WEIGHTS, MODEL_CACHE_MB, **model_kwargs)
 
 # Initialize scheduler
 scheduler = APScheduler()
@@ -45,16 +108,19 @@ logger.info('Starting server')
 @app.route('/')
 def index():
     """
-    :return: Html webpage for viewing the current frame or the requested frame (?id=img00010000000_DD_MM_YYYYTHH_MM_SS)
+    :return: Html webpage for viewing the current frame or the requested frame (?id=img00010000000_DD_MM_YYYYTHH_MM_SS),
+    or status 503 for the current frame while the model is warming up.
     """
     image_id = request.args.get('id')
     if image_id is not None:
         # for requested image ID
         output = {'image_id': image_id}
         logger.info('api-get-index: viewing frame ' + image_id + '.jpg from local data')
+    elif not m.ready:
+        return json.dumps({'ready': False}), 503
     else:
-        # infer new frame
-        output = inference(m)
+        # infer new frame, saved before its annotated image is linked
+        output = inference(m, wait=True)
         logger.info('api-get-index: inferring and viewing new frame ' + str(output))
     html = '''
             <!DOCTYPE html>
@@ -121,40 +187,47 @@ def fetch_data(
 
 def inference(model=m,
               bucket_name=None,
-              subfolder=OUTPUT_FOLDER):
+              subfolder=OUTPUT_FOLDER,
+              augment=False,
+              wait=False):
     """
-    Fetching input frame and inferring with the model. Saving output data locally.
+    Reading input frame and inferring with the model in memory. Saving input and output data locally afterwards.
     :param: model: the model instance.
     :param: bucket_name: the s3 bucket name.
     :param: subfolder: the folder for the output data to be stored in.
+    :param: augment: augmented inference: True, or 'batched' (opt-in) for the augmentations in two forwards.
+    :param: wait: wait for the input and output data to be saved, i.e. before linking the saved frame.
     :return: detection output in dictionary format.
     """
     curr = time.time()
     logger.info('Fetching data')
-    # fetch frame
-    frame = fetch_data(scraper=s)
+    # read frame
+    frame_id, frame = s.read()
     if frame is None:
         output = None
     else:
         logger.info('Running model')
-        # run the model with the input frame and with the confidence threshold. Saving results in output folder
-        output = model.run(source=frame, conf_thres=CONF_THRES, name=subfolder)
+        # run the model with the input frame and with the confidence threshold, on a worker process or batched
+        # with concurrent requests
+        if p is not None and model is m:
+            output = p.infer(frame, frame_id, conf_thres=CONF_THRES, augment=augment)
+        elif b is not None and model is b.model and not augment:
+            output = b.infer(frame, frame_id)
+        else:
+            output = model.infer([frame], ids=[frame_id], conf_thres=CONF_THRES, augment=augment)[0]
 
     # check if output is valid
     if output is not None:
+        # save input and output data off the inference path
+        thread = persist(model, frame, copy.deepcopy(output), bucket_name, subfolder)
+        if wait:
+            thread.join()
+
         # a detection was made
         if not output['detection_results'] == 'no_detections':
             # Replace class number with class name
             output['detection_results']['classes'] = [CLASS_NAME[item] for item in output['detection_results']['classes']]
 
-            # upload label to bucket if bucket exists
-            if bucket_name is not None:
-                s3.upload_to_s3_from_local(subfolder + '/' + 'labels' + '/' + output['image_id'] + '.txt')
-
-        # upload image to bucket if bucket exists
-        if bucket_name is not None:
-            s3.upload_to_s3_from_local(subfolder + '/' + output['image_id'] + '.jpg')
-
         # print the inference time
         inference_time = str(time.time() - curr)
         print('inference time is ' + inference_time + ' seconds')
@@ -163,13 +236,41 @@ def inference(model=m,
     return output
 
 
+@threaded
+def persist(model, frame, output, bucket_name=None, subfolder=OUTPUT_FOLDER):
+    """
+    Saving an inferred frame and its output data locally, on a thread. Uploading output data to s3 bucket.
+    :param: model: the model instance.
+    :param: frame: the inferred frame.
+    :param: output: detection output in dictionary format.
+    :param: bucket_name: the s3 bucket name.
+    :param: subfolder: the folder for the output data to be stored in.
+    """
+    # save input frame
+    if SAVE_INPUT_FRAMES:
+        s.save(frame, output['image_id'], INPUT_FOLDER)
+
+    # save label and annotated frame
+    if SAVE_OUTPUT_FRAMES:
+        model.save([frame], [output], save_dir=subfolder)
+
+        # upload image and label to bucket if bucket exists
+        if bucket_name is not None:
+            if not output['detection_results'] == 'no_detections':
+                s3.upload_to_s3_from_local(subfolder + '/' + 'labels' + '/' + output['image_id'] + '.txt')
+            s3.upload_to_s3_from_local(subfolder + '/' + output['image_id'] + '.jpg')
+
+
 @app.route("/detect_trucks", methods=["GET"])
 def detect_trucks():
     """
-    REST API GET for an inference.
-    :return: detection output in json format.
+    REST API GET for an inference, augmented with ?augment=true or ?augment=batched (two forwards).
+    :return: detection output in json format, or status 503 while the model is warming up.
     """
-    output = inference()
+    if not m.ready:
+        return json.dumps({'ready': False}), 503
+    augment = {'true': True, 'batched': 'batched'}.get(request.args.get('augment', '').lower(), False)
+    output = inference(models.get(camera), augment=augment)
     logger.info('api-get-detect_trucks: ' + str(output))
     return json.dumps(output), 200
 
@@ -180,7 +281,9 @@ def inference_post():
     """
     REST API POST for an inference.
     """
-    output = inference()
+    if not m.ready:
+        return
+    output = inference(models.get(camera))
     # a detection was made
     if output is not None:
         if not output['detection_results'] == 'no_detections':
@@ -192,6 +295,16 @@ def inference_post():
     print(output)
 
 
+@app.route("/ready", methods=["GET"])
+def ready():
+    """
+    REST API GET for the server's readiness, i.e. for a load balancer health check.
+    :return: readiness in json format, with status 200 once the model is warmed up or 503 before. 'degraded' is true
+    if warming up failed.
+    """
+    return json.dumps({'ready': m.ready, 'degraded': degraded}), 200 if m.ready else 503
+
+
 @app.route("/send_local_data_list", methods=["GET"])
 def send_local_data_list():
     """
@@ -288,6 +401,54 @@ def delete_local_data():
     return json.dumps('{deleted: [' + INPUT_FOLDER + ', ' + OUTPUT_FOLDER + ']}'), 200
 
 
+# REST POST action
+@app.route("/admin/swap_model", methods=["POST"])
+def swap_model():
+    """
+    REST API POST for swapping the model's weights without downtime.
+    Can be new weights by file name in SWAP_WEIGHTS_DIR (weights=best_v2.pt, for example) or reloading the current
+    weights file. Other paths are refused, since loading a weights file unpickles it.
+    The new weights are loaded, warmed up and validated on the current frame in the background while serving continues.
+    :return: the weights being swapped in and the report of the last completed swap in json format, status 400 for
+    weights outside SWAP_WEIGHTS_DIR, or status 409 while the worker pool serves requests, since its workers would keep
+    serving the old weights.
+    """
+    if p is not None:
+        return json.dumps({'error': 'swaps are not supported while the worker pool serves requests'}), 409
+    name = request.values.get('weights')
+    weights = m.weights
+    if name is not None:
+        folder = os.path.realpath(SWAP_WEIGHTS_DIR)
+        weights = os.path.realpath(os.path.join(folder, name))
+        if os.path.basename(name) != name or os.path.dirname(weights) != folder or not os.path.isfile(weights):
+            return json.dumps({'error': 'weights must be the name of a file in ' + SWAP_WEIGHTS_DIR}), 400
+    swap_weights(weights)
+    logger.info('api-post-swap_model: swapping in ' + str(weights))
+    return json.dumps({'swapping': str(weights), 'last_swap': m.swap_report}), 200
+
+
+@app.route("/admin/models", methods=["GET"])
+def loaded_models():
+    """
+    REST API GET for the loaded site-specific models of the cameras.
+    :return: the loaded models and their memory in json format.
+    """
+    return json.dumps(models.info()), 200
+
+
+@threaded
+def swap_weights(weights):
+    """
+    Swapping the model's weights on a thread. The old weights keep serving if the new weights fail validation.
+    :param: weights: the new model's weights.
+    """
+    try:
+        report = m.swap(weights, sample=s.vidcap.read())
+        logger.info('Swapped weights: ' + str(report))
+    except Exception as e:
+        logger.error('Swapping weights ' + str(weights) + ' failed, serving the old weights: ' + str(e))
+
+
 def main():
     app.run(host='0.0.0.0', port=80)
 
@@ -1,10 +1,22 @@
+import contextlib
+import numpy as np
+import os
+import threading
+import time
 import torch
 import platform
 
+from concurrent.futures import Future
 from models.common import DetectMultiBackend
+from models.experimental import Ensemble
+from models.yolo import Detect
+from utils.augmentations import LetterboxPlan, bgr_to_nchw, input_slab
 from utils.dataloaders import IMG_FORMATS, VID_FORMATS, LoadImages, LoadScreenshots, LoadStreams
-from utils.general import (LOGGER, Profile, check_file, check_img_size, check_imshow, check_requirements, colorstr, cv2,
-                           increment_path, non_max_suppression, print_args, scale_boxes, strip_optimizer, xyxy2xywh)
+from utils import threaded
+from utils.codec import CODEC
+from utils.general import (LOGGER, PeakMemory, Profile, check_file, check_img_size, check_imshow, check_requirements,
+                           colorstr, cv2, increment_path, non_max_suppression, print_args, scale_boxes, strip_optimizer,
+                           weighted_boxes_fusion, xywhn2xyxy, xyxy2xywh)
 from utils.plots import Annotator, colors, save_one_box
 from utils.torch_utils import select_device, smart_inference_mode
 from pathlib import Path
@@ -15,21 +27,72 @@ class Model:
     Class Model.
     Using the YOLOV5 ML model for an image inference.
     """
-    def __init__(self, weights):
+    def __init__(self,
+                 weights,
+                 data='coco128.yaml',
+                 imgsz=(640, 640),
+                 device='',
+                 half=False,
+                 dnn=False,
+                 frame_shapes=(),
+                 batch_sizes=(1,),
+                 merge='nms',
+                 **kwargs,
+                 ):
         """
+        Loading the model's weights once into a long-lived inference engine and warming it up.
         :param: weights: the model's weights.
+        :param: data: dataset.yaml path.
+        :param: imgsz: inference size (height, width).
+        :param: device: cuda device, i.e. 0 or 0,1,2,3 or cpu
+        :param: half: use FP16 half-precision inference.
+        :param: dnn: use OpenCV DNN for ONNX inference.
+        :param: frame_shapes: frame shapes (height, width) of the cameras to precompute the Detect head grids for
+        and to warm up on.
+        :param: batch_sizes: batch sizes to warm up on.
+        :param: merge: how the detections of an ensemble of weights are merged: 'nms' over all the models' boxes, or
+        'wbf' weighted boxes fusion of each model's boxes.
+        :param: kwargs: inference engine backend options, i.e. pt_options: PyTorch eager or compiled mode,
+        onnx_options: ONNX Runtime session options, openvino_options: OpenVINO performance hint, streams and infer
+        requests, thread_options: threading policy (set_threads()) of the sessions and the number of inferences running
+        at once ('concurrency', 0 is unbounded).
         :return: a Model instance.
         """
         self.weights = weights
+        self.data, self.half, self.dnn, self.kwargs = data, half, dnn, kwargs
+        self.frame_shapes, self.batch_sizes = frame_shapes, batch_sizes
+        assert merge in ('nms', 'wbf'), f'invalid ensemble merge {merge}'
+        self.merge = merge
+        self.device = select_device(device)
+        self.model = DetectMultiBackend(weights, device=self.device, dnn=dnn, data=data, fp16=half, **kwargs)
+        self.imgsz = check_img_size(imgsz, s=self.model.stride)  # check image size
+        self.model.warmup(imgsz=(1, 3, *self.imgsz))  # warmup
+        self._precompute_grids(self.model, self.imgsz)
+        self.swap_lock = threading.Lock()  # one weights swap at a time
+        self.swap_report = None  # latency and memory of the last weights swap
+        self.ready = False  # warmed up on every frame shape and batch size, see warmup()
+        concurrency = (kwargs.get('thread_options') or {}).get('concurrency', 0)
+        self.slots = threading.BoundedSemaphore(concurrency) if concurrency else contextlib.nullcontext()
+
+    @property
+    def stride(self):
+        return self.model.stride
+
+    @property
+    def names(self):
+        return self.model.names
 
+    @property
+    def pt(self):
+        return self.model.pt
+
+    @smart_inference_mode()
     def run(self,
             source='input_data',
-            data='coco128.yaml',
-            imgsz=(640, 640),
+            imgsz=None,
             conf_thres=0.25,
             iou_thres=0.45,
             max_det=1000,
-            device='',
             view_img=False,
             save_txt=True,
             save_conf=True,
@@ -46,20 +109,17 @@ class Model:
             line_thickness=3,
             hide_labels=False,
             hide_conf=False,
-            half=False,
-            dnn=False,
             vid_stride=1,
+            reduced_decode=True,
             ):
         """
-        This function runs the model with the weights given for the class instance.
+        This function runs the model's inference engine on the given source.
         :param: self: the model instance.
         :param: source: image file or folder to infer.
-        :param: data: dataset.yaml path.
-        :param: imgsz: inference size (height, width).
+        :param: imgsz: inference size (height, width). Defaults to the size the engine was warmed up with.
         :param: conf_thres: confidence threshold.
         :param: iou_thres: NMS IOU threshold.
         :param: max_det: maximum detections per image.
-        :param: device: cuda device, i.e. 0 or 0,1,2,3 or cpu
         :param: view_img: show results.
         :param: save_txt: save results to *.txt.
         :param: save_conf: save confidences in --save-txt labels.
@@ -67,7 +127,7 @@ class Model:
         :param: nosave: do not save images/videos.
         :param: classes: filter by class: --class 0, or --class 0 2 3.
         :param: agnostic_nms: class-agnostic NMS.
-        :param: augment: augmented inference.
+        :param: augment: augmented inference: True, or 'batched' (opt-in) for the augmentations in two forwards.
         :param: visualize: visualize features.
         :param: update: update all models.
         :param: project: save results to project/name.
@@ -76,9 +136,9 @@ class Model:
         :param: line_thickness: bounding box thickness (pixels).
         :param: hide_labels: hide labels.
         :param: hide_conf: hide confidences.
-        :param: half: use FP16 half-precision inference.
-        :param: dnn: use OpenCV DNN for ONNX inference.
         :param: vid_stride: video frame-rate stride.
+        :param: reduced_decode: decode JPEGs at least 2x larger than imgsz at 1/2, 1/4 or 1/8 resolution. Boxes are
+        output in the original image's coordinates, the saved images and crops are of the reduced image.
         :return: The output dictionary in the format {"image_id": ..., "detection_results": ...}
         """
         weights = self.weights
@@ -95,43 +155,49 @@ class Model:
         save_dir = increment_path(Path(project) / name, exist_ok=exist_ok)  # increment run
         (save_dir / 'labels' if save_txt else save_dir).mkdir(parents=True, exist_ok=True)  # make dir
 
-        # Load model
-        device = select_device(device)
-        model = DetectMultiBackend(weights, device=device, dnn=dnn, data=data, fp16=half)
+        # Persistent inference engine
+        model = self.model  # in-flight runs finish on this engine if weights are swapped meanwhile
         stride, names, pt = model.stride, model.names, model.pt
-        imgsz = check_img_size(imgsz, s=stride)  # check image size
+        imgsz = self.imgsz if imgsz is None else check_img_size(imgsz, s=stride)  # check image size
 
-        # Dataloader
+        # Dataloader, images and screenshots are letterboxed by _preprocess() (transforms=np.asarray keeps im0)
         bs = 1  # batch_size
         if webcam:
             view_img = check_imshow(warn=True)
             dataset = LoadStreams(source, img_size=imgsz, stride=stride, auto=pt, vid_stride=vid_stride)
             bs = len(dataset)
         elif screenshot:
-            dataset = LoadScreenshots(source, img_size=imgsz, stride=stride, auto=pt)
+            dataset = LoadScreenshots(source, img_size=imgsz, stride=stride, auto=pt, transforms=np.asarray)
         else:
-            dataset = LoadImages(source, img_size=imgsz, stride=stride, auto=pt, vid_stride=vid_stride)
+            dataset = LoadImages(source, img_size=imgsz, stride=stride, auto=pt, transforms=np.asarray,
+                                 vid_stride=vid_stride, reduce=reduced_decode)
         vid_path, vid_writer = [None] * bs, [None] * bs
 
         # Run inference
-        model.warmup(imgsz=(1 if pt or model.triton else bs, 3, *imgsz))  # warmup
         seen, windows, dt = 0, [], (Profile(), Profile(), Profile())
         for path, im, im0s, vid_cap, s in dataset:
-            with dt[0]:
-                im = torch.from_numpy(im).to(model.device)
-                im = im.half() if model.fp16 else im.float()  # uint8 to fp16/32
-                im /= 255  # 0 - 255 to 0.0 - 1.0
-                if len(im.shape) == 3:
-                    im = im[None]  # expand for batch dim
-
-            # Inference
-            with dt[1]:
-                visualize = increment_path(save_dir / Path(path).stem, mkdir=True) if visualize else False
-                pred = model(im, augment=augment, visualize=visualize)
+            with contextlib.ExitStack() as slab:
+                with dt[0]:
+                    if webcam:  # letterboxed stream batch
+                        im = torch.from_numpy(im).to(model.device)
+                        im = im.half() if model.fp16 else im.float()  # uint8 to fp16/32
+                        im /= 255  # 0 - 255 to 0.0 - 1.0
+                    else:  # cached letterbox plan and single-pass conversion into a pooled input slab
+                        im = slab.enter_context(self._preprocess([im0s], imgsz, model))
+
+                # Inference
+                with dt[1]:
+                    visualize = increment_path(save_dir / Path(path).stem, mkdir=True) if visualize else False
+                    with self.slots:  # bounded concurrent inferences, shared with infer()
+                        pred = model(im, augment=augment, visualize=visualize)
 
             # NMS
             with dt[2]:
-                pred = non_max_suppression(pred, conf_thres, iou_thres, classes, agnostic_nms, max_det=max_det)
+                if self.merge == 'wbf' and isinstance(getattr(model, 'model', None), Ensemble):  # per model outputs
+                    pred = weighted_boxes_fusion(pred[1], conf_thres, iou_thres, classes, agnostic_nms,
+                                                 max_det=max_det)
+                else:
+                    pred = non_max_suppression(pred, conf_thres, iou_thres, classes, agnostic_nms, max_det=max_det)
 
             # Second-stage classifier (optional)
             # pred = utils.general.apply_classifier(pred, classifier_model, im, im0s)
@@ -149,47 +215,41 @@ class Model:
                 save_path = str(save_dir / p.name)  # im.jpg
                 txt_path = str(save_dir / 'labels' / p.stem) + ('' if dataset.mode == 'image' else f'_{frame}')  # im.txt
                 s += '%gx%g ' % im.shape[2:]  # print string
-                gn = torch.tensor(im0.shape)[[1, 0, 1, 0]]  # normalization gain whwh
+                reduction = getattr(dataset, 'reduction', 1)  # original image pixels per im0 pixel
+                shape0 = getattr(dataset, 'shape0', None) or im0.shape[:2]  # original image shape
+                auto = dataset.auto if webcam else None  # streams of different shapes are letterboxed to imgsz
+                (r, _), pad = self._letterbox_plan(im0, imgsz, model, auto).ratio_pad  # im0 letterbox geometry
                 imc = im0.copy() if save_crop else im0  # for save_crop
                 annotator = Annotator(im0, line_width=line_thickness, example=str(names))
                 if len(det):
-                    # Rescale boxes from img_size to im0 size
-                    det[:, :4] = scale_boxes(im.shape[2:], det[:, :4], im0.shape).round()
+                    # Rescale boxes from img_size to the original image size, the same mapping as infer()
+                    det[:, :4] = scale_boxes(im.shape[2:], det[:, :4], shape0, ((r / reduction,) * 2, pad)).round()
 
                     # Print results
                     for c in det[:, 5].unique():
                         n = (det[:, 5] == c).sum()  # detections per class
                         s += f"{n} {names[int(c)]}{'s' * (n > 1)}, "  # add to string
 
-                    # Write results
-                    for *xyxy, conf, cls in reversed(det):
-                        if save_txt:  # Write to file
-                            xywh = (xyxy2xywh(torch.tensor(xyxy).view(1, 4)) / gn).view(-1).tolist()  # normalized xywh
-                            line = (cls, *xywh, conf) if save_conf else (cls, *xywh)  # label format
-                            with open(f'{txt_path}.txt', 'a') as f:
-                                f.write(('%g ' * len(line)).rstrip() % line + '\n')
+                    # Convert all detections at once, lowest confidence first
+                    results = self._detection_results(det, shape0)
+                    xyxys = (det[:, :4].flip(0) / reduction).tolist()  # im0 pixels
 
+                    # Write results
+                    lines = []
+                    for c, conf, xywh, xyxy in zip(results['classes'], results['probabilities'],
+                                                   results['bboxs_cx_cy_w_h_fractional'], xyxys):
+                        if save_txt:
+                            line = (c, *xywh, conf) if save_conf else (c, *xywh)  # label format
+                            lines.append(('%g ' * len(line)).rstrip() % line + '\n')
                         if save_img or save_crop or view_img:  # Add bbox to image
-                            c = int(cls)  # integer class
                             label = None if hide_labels else (names[c] if hide_conf else f'{names[c]} {conf:.2f}')
                             annotator.box_label(xyxy, label, color=colors(c, True))
                         if save_crop:
                             save_one_box(xyxy, imc, file=save_dir / 'crops' / names[c] / f'{p.stem}.jpg', BGR=True)
-
-                    # if detected, write output to a dictionary
-                    classes = list()
-                    probabilities = list()
-                    bboxs_cx_cy_w_h_fractional = list()
-                    for *xyxy, conf, cls in reversed(det):
-                        xywh = (xyxy2xywh(torch.tensor(xyxy).view(1, 4)) / gn).view(-1).tolist()  # normalized xywh
-                        # print((p.name[:-4], cls, conf, *xywh))
-                        classes.append(int(cls.item()))
-                        probabilities.append(conf.item())
-                        bboxs_cx_cy_w_h_fractional.append([*xywh])
-                    detection_results = {'classes': classes,
-                                         'probabilities': probabilities,
-                                         'bboxs_cx_cy_w_h_fractional': bboxs_cx_cy_w_h_fractional}
-                    output_dict = {'image_id': p.name[:-4], 'detection_results': detection_results}
+                    if save_txt:  # Write to file
+                        with open(f'{txt_path}.txt', 'a') as f:
+                            f.writelines(lines)
+                    output_dict = {'image_id': p.name[:-4], 'detection_results': results}
                 else:
                     output_dict = {'image_id': p.name[:-4], 'detection_results': 'no_detections'}
 
@@ -206,7 +266,7 @@ class Model:
                 # Save results (image with detections)
                 if save_img:
                     if dataset.mode == 'image':
-                        cv2.imwrite(save_path, im0)
+                        CODEC.imwrite(save_path, im0)
                     else:  # 'video' or 'stream'
                         if vid_path[i] != save_path:  # new video
                             vid_path[i] = save_path
@@ -236,3 +296,399 @@ class Model:
 
         # Return output dictionary
         return output_dict
+
+    @smart_inference_mode()
+    def infer(self,
+              frames,
+              ids=None,
+              imgsz=None,
+              conf_thres=0.25,
+              iou_thres=0.45,
+              max_det=1000,
+              classes=None,
+              agnostic_nms=False,
+              augment=False,
+              ):
+        """
+        This function runs the model's inference engine on frames held in memory, i.e. straight from
+        VideoCapture.read(), without encoding them to disk and decoding them back. Nothing is saved, see save().
+        Frames with the same letterboxed shape are inferred together in one batched forward and NMS.
+        On an OpenVINO engine in throughput mode the batches are inferred concurrently on its async infer requests.
+        :param: self: the model instance.
+        :param: frames: list of BGR images (numpy arrays of shape (height, width, 3)).
+        :param: ids: list of image IDs, one per frame. Defaults to the frame's index in the list.
+        :param: imgsz: inference size (height, width). Defaults to the size the engine was warmed up with.
+        :param: conf_thres: confidence threshold.
+        :param: iou_thres: NMS IOU threshold.
+        :param: max_det: maximum detections per image.
+        :param: classes: filter by class: --class 0, or --class 0 2 3.
+        :param: agnostic_nms: class-agnostic NMS.
+        :param: augment: augmented inference: True, or 'batched' (opt-in) for the augmentations in two forwards.
+        :return: A list of output dictionaries in the format {"image_id": ..., "detection_results": ...}
+        """
+        model = self.model  # in-flight inferences finish on this engine if weights are swapped meanwhile
+        imgsz = self.imgsz if imgsz is None else check_img_size(imgsz, s=model.stride)  # check image size
+        ids = [str(i) for i in range(len(frames))] if ids is None else ids
+
+        # Group frames by letterboxed shape into batches
+        plans = [self._letterbox_plan(im0, imgsz, model) for im0 in frames]
+        batches = {}
+        for i, plan in enumerate(plans):
+            batches.setdefault(plan.out_shape, []).append(i)
+        n = self._batch_size(model) or len(frames)  # max frames per batch
+        batches = [b[j:j + n] for b in batches.values() for j in range(0, len(b), n)]
+
+        def postprocess(batch, pred):  # NMS and rescale a batch's predictions into outputs
+            if self.merge == 'wbf' and isinstance(getattr(model, 'model', None), Ensemble):  # per model outputs
+                pred = weighted_boxes_fusion(pred[1], conf_thres, iou_thres, classes, agnostic_nms, max_det=max_det)
+            else:
+                pred = non_max_suppression(pred, conf_thres, iou_thres, classes, agnostic_nms, max_det=max_det)
+            shape = plans[batch[0]].out_shape  # letterboxed shape
+            for i, det in zip(batch, pred):  # per image
+                im0 = frames[i]
+                det[:, :4] = scale_boxes(shape, det[:, :4], im0.shape, plans[i].ratio_pad).round()  # to im0 size
+                outputs[i] = {'image_id': ids[i], 'detection_results': self._detection_results(det, im0.shape)}
+
+        # Inference, batches run in parallel on the infer requests of an OpenVINO throughput mode engine. Synchronous
+        # predictions are post-processed right away, as they may be views into buffers the next forward overwrites
+        outputs, futures = [None] * len(frames), []
+        for batch in batches:
+            with self._preprocess([frames[i] for i in batch], imgsz, model) as im:  # async engines copy the slab
+                if getattr(model, 'async_queue', None) is not None:
+                    futures.append((batch, Future()))
+                    model.forward_async(im, futures[-1][1])
+                    continue
+                with self.slots:  # bounded concurrent inferences
+                    pred = model(im, augment=augment)
+            postprocess(batch, pred)
+        for batch, future in futures:
+            postprocess(batch, future.result(timeout=model.async_timeout))  # raises the failed requests' exceptions
+        return outputs
+
+    def save(self,
+             frames,
+             outputs,
+             save_dir='',
+             save_txt=True,
+             save_conf=True,
+             save_img=True,
+             line_thickness=3,
+             hide_labels=False,
+             hide_conf=False,
+             ):
+        """
+        Saving the outputs of infer() for in-memory frames: a label file per frame with detections into
+        save_dir/labels and the annotated frame into save_dir, with the same names and formats as run().
+        :param: self: the model instance.
+        :param: frames: list of BGR images which were inferred.
+        :param: outputs: list of output dictionaries returned by infer(), one per frame.
+        :param: save_dir: the folder for the output data to be stored in.
+        :param: save_txt: save results to *.txt.
+        :param: save_conf: save confidences in --save-txt labels.
+        :param: save_img: save annotated images.
+        :param: line_thickness: bounding box thickness (pixels).
+        :param: hide_labels: hide labels.
+        :param: hide_conf: hide confidences.
+        """
+        save_dir = Path(save_dir)
+        (save_dir / 'labels' if save_txt else save_dir).mkdir(parents=True, exist_ok=True)  # make dir
+        for im0, output in zip(frames, outputs):
+            image_id, results = output['image_id'], output['detection_results']
+            annotator = Annotator(im0.copy(), line_width=line_thickness, example=str(self.names))
+            if results != 'no_detections':
+                h, w = im0.shape[:2]
+                xywhn = results['bboxs_cx_cy_w_h_fractional']
+                xyxys = xywhn2xyxy(np.array(xywhn).reshape(-1, 4), w, h)
+                lines = []
+                for cls, conf, xywh, xyxy in zip(results['classes'], results['probabilities'], xywhn, xyxys):
+                    line = (cls, *xywh, conf) if save_conf else (cls, *xywh)  # label format
+                    lines.append(('%g ' * len(line)).rstrip() % line + '\n')
+                    if save_img:  # Add bbox to image
+                        name = self.names[cls]
+                        label = None if hide_labels else (name if hide_conf else f'{name} {conf:.2f}')
+                        annotator.box_label(xyxy, label, color=colors(cls, True))
+                if save_txt:  # Write to file
+                    with open(save_dir / 'labels' / f'{image_id}.txt', 'a') as f:
+                        f.writelines(lines)
+            if save_img:
+                CODEC.imwrite(save_dir / f'{image_id}.jpg', annotator.result())
+
+    @smart_inference_mode()
+    def swap(self, weights, sample=None):
+        """
+        Swapping the model's weights without downtime. The new weights are loaded into a second inference engine
+        next to the serving one, warmed up and validated on a sample frame, and then swapped in atomically.
+        In-flight inferences finish on the old engine, which is released once they are done.
+        :param: self: the model instance.
+        :param: weights: the new model's weights.
+        :param: sample: BGR image to validate the new engine on. Defaults to a gray frame.
+        :return: The swap report in the format {"weights": ..., "swap_latency_s": ..., "peak_rss_mb": ..., ...}
+        """
+        with self.swap_lock, PeakMemory() as mem:
+            t = time.time()
+            model = DetectMultiBackend(weights, device=self.device, dnn=self.dnn, data=self.data, fp16=self.half,
+                                       **self.kwargs)
+            imgsz = check_img_size(self.imgsz, s=model.stride)  # check image size
+            model.warmup(imgsz=(1, 3, *imgsz))  # warmup
+            self._precompute_grids(model, imgsz)
+            self._warmup(model, imgsz)
+            self._validate(model, imgsz, sample)
+            t_ready = time.time()
+            self.model, self.imgsz, self.weights = model, imgsz, weights  # atomic swap
+            t_swapped = time.time()
+
+        mb = 1 << 20  # bytes to MiB
+        self.swap_report = {'weights': str(weights),
+                            'load_warmup_validate_s': round(t_ready - t, 3),
+                            'swap_latency_s': round(t_swapped - t_ready, 6),
+                            'rss_before_mb': round(mem.start / mb, 1),
+                            'peak_rss_mb': round(mem.peak / mb, 1),
+                            'rss_after_mb': round(mem.end / mb, 1)}
+        LOGGER.info(f'Swapped weights: {self.swap_report}')
+        return self.swap_report
+
+    @smart_inference_mode()
+    def warmup(self):
+        """
+        Warming up the inference engine on every letterboxed frame shape and batch size, on CPU too, so that the first
+        requests do not pay for allocator growth, oneDNN primitive creation and grid building. Sets the model ready.
+        :param: self: the model instance.
+        :return: the warmup time (seconds).
+        """
+        with Profile() as dt:
+            self._warmup(self.model, self.imgsz)
+        self.ready = True
+        LOGGER.info(f'Warmed up on frame shapes {list(self.frame_shapes)} and batch sizes {list(self.batch_sizes)} '
+                    f'in {dt.t:.1f}s, ready')
+        return dt.t
+
+    @threaded
+    def watch(self, interval=10):
+        """
+        Watching the weights file on a thread, swapping the weights in when the file is modified.
+        :param: self: the model instance.
+        :param: interval: the time (seconds) between checks of the file.
+        """
+        last = None
+        while True:
+            try:
+                weights = self.weights
+                stamp = weights, os.path.getmtime(weights), os.path.getsize(weights)
+            except (OSError, TypeError):  # file being replaced, or not a local file
+                stamp = None
+            if None not in (last, stamp) and stamp[0] == last[0] and stamp != last:
+                try:
+                    self.swap(weights)
+                except Exception as e:
+                    LOGGER.warning(f'WARNING ⚠️ weights swap of {weights} failed, serving the old weights: {e}')
+            last = stamp or last
+            time.sleep(interval)
+
+    @classmethod
+    def select(cls, weights, policy='p95', frames=None, n=20, int8_max_map_drop=None, **kwargs):
+        """
+        Benchmarking the weights and each of their exported artifacts (i.e. best.onnx, best_openvino_model) on
+        frames at startup, and loading the fastest inference engine on this host.
+        :param: weights: the model's PyTorch weights.
+        :param: policy: p95 selects the lowest p95 latency of single frames, throughput the most frames per second
+        of frames inferred together.
+        :param: frames: list of BGR images to benchmark on. Defaults to n synthetic frames.
+        :param: n: number of frames to benchmark on.
+        :param: int8_max_map_drop: INT8 exports (i.e. best_int8.onnx) are candidates only if the mAP50-95 of their
+        export report (export.py --int8, FP32 detections as labels) is at least 1 - int8_max_map_drop. None excludes
+        INT8 exports.
+        :param: kwargs: Model arguments, i.e. imgsz.
+        :return: a Model instance of the selected inference engine.
+        """
+        assert policy in ('p95', 'throughput'), f'invalid backend selection policy {policy}'
+        rng = np.random.default_rng(0)
+        frames = (frames or [rng.integers(0, 256, (720, 1280, 3), dtype=np.uint8) for _ in range(n)])[:n]
+        gpu = select_device(kwargs.get('device', '')).type != 'cpu'
+        cache = (kwargs.get('onnx_options') or {}).get('optimized_model_filepath')  # not an export
+        best, results = None, {}
+        for w in [str(weights)] + [x for x in cls.artifacts(weights, gpu) if x != cache]:
+            if '_int8' in Path(w).name:
+                ap = cls.int8_map(w)
+                if int8_max_map_drop is None or ap is None or 1 - ap > int8_max_map_drop:
+                    LOGGER.info(f'Backend {w} skipped, INT8 mAP50-95 {ap} vs. FP32 (max drop {int8_max_map_drop})')
+                    continue
+            try:
+                model = cls(w, **kwargs)
+                model.infer(frames[:1])  # warmup
+                t = []
+                for frame in frames:
+                    t0 = time.perf_counter()
+                    model.infer([frame])
+                    t.append(time.perf_counter() - t0)
+                t0 = time.perf_counter()
+                model.infer(frames)
+                fps = len(frames) / (time.perf_counter() - t0)
+            except Exception as e:
+                LOGGER.warning(f'WARNING ⚠️ backend {w} skipped: {e}')
+                continue
+            results[w] = {'p50_ms': np.percentile(t, 50) * 1E3, 'p95_ms': np.percentile(t, 95) * 1E3, 'fps': fps}
+            score = (lambda r: -r['p95_ms']) if policy == 'p95' else (lambda r: r['fps'])
+            if best is None or score(results[w]) > score(results[best.weights]):
+                best = model
+            del model  # release engines that are not the fastest so far
+
+        assert best is not None, f'no backend of {weights} could be benchmarked'
+        lines = [f"{'backend':<40s}{'p50 ms':>10s}{'p95 ms':>10s}{'frames/s':>10s}"]
+        for w, r in results.items():
+            selected = '  <- selected' if w == best.weights else ''
+            lines.append(f"{w:<40s}{r['p50_ms']:>10.1f}{r['p95_ms']:>10.1f}{r['fps']:>10.1f}{selected}")
+        LOGGER.info(f"{colorstr('Backend selection:')} {policy} policy, {len(frames)} frames\n" + '\n'.join(lines))
+        return best
+
+    @staticmethod
+    def artifacts(weights, gpu=False):
+        """
+        Finding the exported artifacts of the weights next to them, i.e. best.onnx, best_int8.onnx, best.torchscript
+        and best_openvino_model for best.pt.
+        :param: weights: the model's PyTorch weights.
+        :param: gpu: find the formats that run on GPU instead of CPU.
+        :return: list of the artifacts' paths.
+        """
+        from export import export_formats
+
+        fmts = export_formats()
+        suffixes = tuple(fmts.Suffix[fmts.GPU if gpu else fmts.CPU])[1:]  # exported formats, PyTorch excluded
+        w = Path(weights)
+        return [str(x) for x in sorted(w.parent.glob(f'{w.stem}*'))
+                if x.name[len(w.stem):][:1] in ('.', '_', '-') and x.name.endswith(suffixes) and x != w]
+
+    @staticmethod
+    def int8_map(artifact):
+        """
+        Reading the accuracy of an INT8 export from the report export.py --int8 wrote next to it, i.e.
+        best_int8_report.txt for best_int8.onnx.
+        :param: artifact: the INT8 export.
+        :return: its mAP50-95 with the FP32 model's detections as labels, or None without a report or detections.
+        """
+        f = Path(str(artifact).replace('.onnx', '_report.txt').replace('.torchscript', '_torchscript_report.txt'))
+        try:
+            for line in f.read_text().splitlines():
+                x = line.split()
+                if x[:1] == ['INT8'] and x[2:3] == ['all']:  # INT8 <format> all instances P R mAP50 mAP50-95 ms
+                    return float(x[7])
+        except (OSError, ValueError, IndexError):  # no report, or n/a without FP32 detections
+            pass
+        return None
+
+    def _validate(self, model, imgsz, sample=None):
+        """
+        Validating a new inference engine against the serving one by inferring a sample frame.
+        :param: model: the new inference engine.
+        :param: imgsz: inference size (height, width).
+        :param: sample: BGR image. Defaults to a gray frame.
+        """
+        if len(model.names) != len(self.names):
+            raise ValueError(f'new weights have {len(model.names)} classes, the served weights {len(self.names)}')
+        im0 = np.full((*imgsz, 3), 114, dtype=np.uint8) if sample is None else sample
+        with self._preprocess([im0], imgsz, model) as im:
+            pred = model(im)
+        pred = pred[0] if isinstance(pred, (list, tuple)) else pred
+        if pred.shape[-1] != len(self.names) + 5 or not torch.isfinite(pred).all():
+            raise ValueError(f'new weights produce an invalid output of shape {tuple(pred.shape)}')
+        non_max_suppression(pred)
+
+    def _precompute_grids(self, model, imgsz):
+        """
+        Precomputing the Detect head grids of the cameras' letterboxed frame shapes for PyTorch weights, so that
+        interleaved frames of different shapes never rebuild them.
+        :param: self: the model instance.
+        :param: model: the inference engine.
+        :param: imgsz: inference size (height, width).
+        """
+        if model.pt and self.frame_shapes:
+            for m in model.model.modules():
+                if isinstance(m, Detect):
+                    m.precompute(self._shapes(model, imgsz))
+
+    def _warmup(self, model, imgsz):
+        """
+        Warming up an inference engine on the cameras' letterboxed frame shapes in every batch size it infers.
+        :param: self: the model instance.
+        :param: model: the inference engine.
+        :param: imgsz: inference size (height, width).
+        """
+        n = self._batch_size(model)  # max frames per batch
+        for shape in self._shapes(model, imgsz):
+            for bs in sorted({min(bs, n) if n else bs for bs in self.batch_sizes}):
+                model.warmup(imgsz=(bs, 3, *shape), cpu=True)
+
+    def _shapes(self, model, imgsz):
+        """
+        :param: self: the model instance.
+        :param: model: the inference engine.
+        :param: imgsz: inference size (height, width).
+        :return: the sorted letterboxed shapes (height, width) of the cameras' frames, or imgsz if not configured.
+        """
+        shapes = {self._letterbox_plan(np.empty((h, w, 3), np.uint8), imgsz, model).out_shape
+                  for h, w in self.frame_shapes}
+        return sorted(shapes) or [tuple(imgsz)]
+
+    @staticmethod
+    def _batch_size(model):
+        """
+        Finding the maximum batch size an inference engine accepts.
+        :param: model: the inference engine.
+        :return: None if any batch size is accepted, else the engine's fixed batch size.
+        """
+        if model.pt or model.triton:
+            return None
+        if model.onnx and not model.dnn:
+            b = model.session.get_inputs()[0].shape[0]
+            return None if isinstance(b, str) else b  # dynamic axes are named
+        if model.engine and model.dynamic:
+            return model.batch_size
+        return 1
+
+    @staticmethod
+    def _letterbox_plan(im0, imgsz, model, auto=None):
+        """
+        Getting the cached letterbox geometry of a frame's resolution, computed once per camera resolution.
+        :param: im0: BGR image.
+        :param: imgsz: inference size (height, width).
+        :param: model: the inference engine.
+        :param: auto: pad to the minimum rectangle of the stride. Defaults to the engine being PyTorch.
+        :return: the LetterboxPlan of the frame's shape.
+        """
+        imgsz = imgsz if isinstance(imgsz, int) else tuple(imgsz)  # hashable
+        return LetterboxPlan.get(im0.shape[:2], imgsz, int(model.stride), model.pt if auto is None else auto)
+
+    @staticmethod
+    @contextlib.contextmanager
+    def _preprocess(frames, imgsz, model):
+        """
+        Letterboxing BGR frames of the same letterboxed shape and converting them to a normalized RGB batch tensor on
+        the engine's device, for a with block. Each frame is converted in a single pass into an input slab lent by a
+        pool of slabs per batch size and shape, shared by all threads and reused by later batches.
+        :param: frames: list of BGR images.
+        :param: imgsz: inference size (height, width).
+        :param: model: the inference engine.
+        :return: tensor of shape (len(frames), 3, height, width), valid until the end of the with block.
+        """
+        plans = [Model._letterbox_plan(im0, imgsz, model) for im0 in frames]
+        with input_slab(len(frames), plans[0].out_shape) as im:
+            for x, im0, plan in zip(im, frames, plans):
+                with plan(im0) as im1:  # padded resize into a buffer of the plan
+                    bgr_to_nchw(im1, x)  # HWC BGR to CHW RGB into the slab
+            im = im.to(model.device)
+            yield im.half() if model.fp16 else im
+
+    @staticmethod
+    def _detection_results(det, shape):
+        """
+        Converting rescaled detections of a frame into the detection results of the output dictionary, all at once.
+        :param: det: detections tensor of shape (n, 6) as xyxy, confidence, class in the frame's pixels.
+        :param: shape: the frame's shape.
+        :return: dictionary of classes, probabilities and normalized boxes, or 'no_detections'.
+        """
+        if not len(det):
+            return 'no_detections'
+        det = det.flip(0)  # lowest confidence first
+        gn = torch.tensor(shape, device=det.device)[[1, 0, 1, 0]]  # normalization gain whwh
+        return {'classes': det[:, 5].int().tolist(),
+                'probabilities': det[:, 4].tolist(),
+                'bboxs_cx_cy_w_h_fractional': (xyxy2xywh(det[:, :4]) / gn).tolist()}  # normalized xywh
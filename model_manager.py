@@ -0,0 +1,129 @@
+import os
+import threading
+
+from collections import OrderedDict
+from concurrent.futures import Future
+from model import Model
+from utils.general import LOGGER, PeakMemory, file_hash
+
+
+class ModelManager:
+    """
+    Class ModelManager.
+    Mapping each camera to its site-specific weights and keeping the loaded models in an LRU cache bounded by memory.
+    Cold models are loaded lazily on a background thread while the default model serves their cameras, and the least
+    recently used models are evicted once the cache grows over its memory bound.
+    Cameras with identical weights files share one model, keyed by the files' content hash (a tuple of hashes for
+    ensemble weights).
+    """
+    def __init__(self, default, weights=None, max_mb=1024, **kwargs):
+        """
+        :param: default: the default model instance, serving the cameras without weights of their own and the cameras
+        whose model is loading. Never evicted.
+        :param: weights: dictionary of camera keys to weights, i.e. {'EVLAIM_CAM': 'evlaim.pt'}.
+        :param: max_mb: the maximum memory (MiB) of the loaded models, besides the default model.
+        :param: kwargs: Model arguments, i.e. imgsz.
+        :return: a ModelManager instance.
+        """
+        self.default = default
+        self.weights = weights or {}
+        self.max_mb = max_mb
+        self.kwargs = kwargs
+        self.models = OrderedDict()  # content hash(es): (model, MiB), least recently used first
+        self.loading = {}  # content hash(es): Future of the model
+        self.hashes = {}  # (path, modification time, size): content hash
+        self.lock = threading.Lock()
+        self.load_lock = threading.Lock()  # one model load at a time, for its memory measurement
+
+    def get(self, camera, wait=False):
+        """
+        Getting the model of a camera, loading it on a background thread if it is not loaded.
+        :param: camera: the camera's key.
+        :param: wait: wait for the camera's model to load instead of serving the camera with the default model.
+        :return: the camera's model instance, or the default model while it is loading.
+        """
+        weights = self.weights.get(camera)
+        if weights is None:
+            return self.default
+        key = self._hash(weights)
+        if key == self._hash(self.default.weights):  # same weights as the default model
+            return self.default
+        with self.lock:
+            if key in self.models:
+                self.models.move_to_end(key)  # most recently used
+                return self.models[key][0]
+            future = self.loading.get(key) or self._load(key, weights)
+        return future.result() if wait else self.default
+
+    def info(self):
+        """
+        :return: the loaded models in the format {"weights": ..., "mb": ...}, least recently used first, and the total
+        memory (MiB).
+        """
+        with self.lock:
+            models = [{'weights': str(m.weights), 'mb': round(mb, 1)} for m, mb in self.models.values()]
+        return {'models': models, 'mb': round(sum(x['mb'] for x in models), 1), 'max_mb': self.max_mb}
+
+    def _hash(self, weights):
+        """
+        Hashing a weights file's content, once per file version.
+        :param: weights: the weights file, or a list of ensemble weights files.
+        :return: the content hash, a tuple of the files' hashes for a list, or the weights as given if they are not a
+        local file (i.e. a URL).
+        """
+        if isinstance(weights, (list, tuple)):
+            return tuple(self._hash(w) for w in weights)
+        try:
+            stamp = weights, os.path.getmtime(weights), os.path.getsize(weights)
+        except OSError:
+            return str(weights)
+        if stamp not in self.hashes:
+            self.hashes[stamp] = file_hash(weights)
+        return self.hashes[stamp]
+
+    def _load(self, key, weights):
+        """
+        Loading and warming up a model on a thread, caching it and evicting the least recently used models.
+        Called with the lock held.
+        :param: key: the weights' content hash(es).
+        :param: weights: the weights.
+        :return: a Future of the model instance.
+        """
+        future = Future()
+        self.loading[key] = future
+
+        def load():
+            try:
+                with self.load_lock, PeakMemory() as mem:
+                    model = Model(weights, **self.kwargs)
+                    model.warmup()
+                files = weights if isinstance(weights, (list, tuple)) else [weights]
+                size = sum(os.path.getsize(w) for w in files if os.path.isfile(w))
+                mb = max(mem.end - mem.start, size) / (1 << 20)  # resident memory of the model
+            except Exception as e:
+                LOGGER.warning(f'WARNING ⚠️ loading {weights} failed, its cameras are served by the default model: {e}')
+                with self.lock:
+                    del self.loading[key]
+                future.set_exception(e)
+                return
+            with self.lock:
+                self.models[key] = model, mb
+                del self.loading[key]
+                self._evict()
+            LOGGER.info(f'Loaded {weights} ({mb:.1f}MB), models cache {self.info()}')
+            future.set_result(model)
+
+        t = threading.Thread(target=load)
+        t.daemon = True
+        t.start()
+        return future
+
+    def _evict(self):
+        """
+        Evicting the least recently used models until the cache fits in max_mb, keeping the most recently used one.
+        In-flight inferences finish on an evicted model, which is released once they are done. Called with the lock
+        held.
+        """
+        while len(self.models) > 1 and sum(mb for _, mb in self.models.values()) > self.max_mb:
+            key, (model, mb) = self.models.popitem(last=False)
+            LOGGER.info(f'Evicted {model.weights} ({mb:.1f}MB)')
@@ -7,11 +7,13 @@ import ast
 import contextlib
 import json
 import math
+import os
 import platform
+import threading
 import warnings
 import zipfile
 from collections import OrderedDict, namedtuple
-from copy import copy
+from copy import copy, deepcopy
 from pathlib import Path
 from urllib.parse import urlparse
 
@@ -27,11 +29,11 @@ from torch.cuda import amp
 
 from utils import TryExcept
 from utils.dataloaders import exif_transpose, letterbox
-from utils.general import (LOGGER, ROOT, Profile, check_requirements, check_suffix, check_version, colorstr,
-                           increment_path, is_notebook, make_divisible, non_max_suppression, scale_boxes, xywh2xyxy,
-                           xyxy2xywh, yaml_load)
+from utils.general import (FUSED_DIR, LOGGER, ROOT, Profile, check_requirements, check_suffix, check_version,
+                           colorstr, increment_path, is_notebook, make_divisible, non_max_suppression,
+                           scale_boxes, weights_key, xywh2xyxy, xyxy2xywh, yaml_load)
 from utils.plots import Annotator, colors, save_one_box
-from utils.torch_utils import copy_attr, smart_inference_mode
+from utils.torch_utils import copy_attr, is_compiling, smart_inference_mode
 
 
 def autopad(k, p=None, d=1):  # kernel, padding, dilation
@@ -226,12 +228,17 @@ class SPPF(nn.Module):
         self.m = nn.MaxPool2d(kernel_size=k, stride=1, padding=k // 2)
 
     def forward(self, x):
-        x = self.cv1(x)
+        if is_compiling():  # warnings filters break the compiled graph
+            return self._forward(x)
         with warnings.catch_warnings():
             warnings.simplefilter('ignore')  # suppress torch 1.9.0 max_pool2d() warning
-            y1 = self.m(x)
-            y2 = self.m(y1)
-            return self.cv2(torch.cat((x, y1, y2, self.m(y2)), 1))
+            return self._forward(x)
+
+    def _forward(self, x):
+        x = self.cv1(x)
+        y1 = self.m(x)
+        y2 = self.m(y1)
+        return self.cv2(torch.cat((x, y1, y2, self.m(y2)), 1))
 
 
 class Focus(nn.Module):
@@ -315,7 +322,17 @@ class Concat(nn.Module):
 
 class DetectMultiBackend(nn.Module):
     # YOLOv5 MultiBackend class for python inference on various backends
-    def __init__(self, weights='yolov5s.pt', device=torch.device('cpu'), dnn=False, data=None, fp16=False, fuse=True):
+    def __init__(self,
+                 weights='yolov5s.pt',
+                 device=torch.device('cpu'),
+                 dnn=False,
+                 data=None,
+                 fp16=False,
+                 fuse=True,
+                 onnx_options=None,
+                 openvino_options=None,
+                 pt_options=None,
+                 thread_options=None):
         # Usage:
         #   PyTorch:              weights = *.pt
         #   TorchScript:                    *.torchscript
@@ -342,11 +359,24 @@ class DetectMultiBackend(nn.Module):
             w = attempt_download(w)  # download if not local
 
         if pt:  # PyTorch
-            model = attempt_load(weights if isinstance(weights, list) else w, device=device, inplace=True, fuse=fuse)
+            mmap = (pt_options or {}).get('mmap', True)  # memory-mapped cached fused weights, shared across processes
+            model = attempt_load(weights if isinstance(weights, list) else w, device=device, inplace=True, fuse=fuse,
+                                 mmap=mmap)
             stride = max(int(model.stride.max()), 32)  # model stride
             names = model.module.names if hasattr(model, 'module') else model.names  # get class names
             model.half() if fp16 else model.float()
             self.model = model  # explicitly assign for to(), cpu(), cuda(), half()
+            pt_mode = (pt_options or {}).get('mode', 'eager')  # eager, torchscript or compile
+            assert pt_mode in ('eager', 'torchscript', 'compile'), f'invalid PyTorch mode {pt_mode}'
+            pt_cache = (pt_options or {}).get('cache', True) and not isinstance(weights, list)  # on disk
+            compiled, compile_lock = {}, threading.Lock()  # compiled models per input shape
+            channels_last = (pt_options or {}).get('channels_last', False)  # NHWC memory format, model and input
+            if channels_last:
+                model.to(memory_format=torch.channels_last)
+            bf16 = (pt_options or {}).get('bf16', False) and device.type == 'cpu' and not fp16  # CPU bfloat16 autocast
+            if bf16 and not torch.ops.mkldnn._is_mkldnn_bf16_supported():
+                LOGGER.warning('WARNING ⚠️ bfloat16 is not supported on this CPU, using float32')
+                bf16 = False
         elif jit:  # TorchScript
             LOGGER.info(f'Loading {w} for TorchScript inference...')
             extra_files = {'config.txt': ''}  # model metadata
@@ -357,6 +387,9 @@ class DetectMultiBackend(nn.Module):
                                object_hook=lambda d: {int(k) if k.isdigit() else k: v
                                                       for k, v in d.items()})
                 stride, names = int(d['stride']), d['names']
+                if d.get('qengine', torch.backends.quantized.engine) != torch.backends.quantized.engine:  # INT8 model
+                    torch.backends.quantized.engine = d['qengine']  # weights packed for the engine on load
+                    model = torch.jit.load(w, map_location=device).float()
         elif dnn:  # ONNX OpenCV DNN
             LOGGER.info(f'Loading {w} for ONNX OpenCV DNN inference...')
             check_requirements('opencv-python>=4.5.4')
@@ -366,8 +399,11 @@ class DetectMultiBackend(nn.Module):
             check_requirements(('onnx', 'onnxruntime-gpu' if cuda else 'onnxruntime'))
             import onnxruntime
             providers = ['CUDAExecutionProvider', 'CPUExecutionProvider'] if cuda else ['CPUExecutionProvider']
-            session = onnxruntime.InferenceSession(w, providers=providers)
+            session_options, f = self._onnx_session_options(w, onnx_options or {}, thread_options or {})
+            session = onnxruntime.InferenceSession(f, sess_options=session_options, providers=providers)
             output_names = [x.name for x in session.get_outputs()]
+            io_binding = (onnx_options or {}).get('io_binding', False) and not cuda  # bind preallocated CPU buffers
+            ort_buffers, ort_lock = {}, threading.Lock()  # IO binding buffers per input shape, pooled across threads
             meta = session.get_modelmeta().custom_metadata_map  # metadata
             if 'stride' in meta:
                 stride, names = int(meta['stride']), eval(meta['names'])
@@ -384,7 +420,18 @@ class DetectMultiBackend(nn.Module):
             batch_dim = get_batch(network)
             if batch_dim.is_static:
                 batch_size = batch_dim.get_length()
-            executable_network = ie.compile_model(network, device_name="CPU")  # device_name="MYRIAD" for Intel NCS2
+            ov_options = openvino_options or {}
+            ov_config = {k.upper(): str(ov_options[k]) for k in ('performance_hint', 'num_streams') if k in ov_options}
+            if (thread_options or {}).get('intra_op'):  # threads of all streams
+                ov_config['INFERENCE_NUM_THREADS'] = str(thread_options['intra_op'])
+            executable_network = ie.compile_model(network, device_name="CPU", config=ov_config)  # "MYRIAD" for NCS2
+            async_queue, async_lock = None, threading.Lock()
+            async_timeout = ov_options.get('timeout', 30)  # seconds to wait for an async infer request's output
+            if ov_config.get('PERFORMANCE_HINT') == 'THROUGHPUT':  # async infer requests running in parallel streams
+                from openvino.runtime import AsyncInferQueue
+                async_queue = AsyncInferQueue(executable_network, ov_options.get('num_requests', 0))  # 0 for optimal
+                async_queue.set_callback(self._openvino_callback)
+                LOGGER.info(f'OpenVINO throughput mode with {len(async_queue)} infer requests')
             stride, names = self._load_metadata(Path(w).with_suffix('.yaml'))  # load metadata
         elif engine:  # TensorRT
             LOGGER.info(f'Loading {w} for TensorRT inference...')
@@ -512,7 +559,15 @@ class DetectMultiBackend(nn.Module):
             im = im.permute(0, 2, 3, 1)  # torch BCHW to numpy BHWC shape(1,320,192,3)
 
         if self.pt:  # PyTorch
-            y = self.model(im, augment=augment, visualize=visualize) if augment or visualize else self.model(im)
+            if augment or visualize:
+                y = self.model(im, augment=augment, visualize=visualize)
+            else:
+                if self.channels_last:
+                    im = im.contiguous(memory_format=torch.channels_last)
+                with torch.autocast('cpu', dtype=torch.bfloat16, enabled=self.bf16):
+                    y = self.model(im) if self.pt_mode == 'eager' else self._pt_compiled(im)(im)
+                if self.bf16:
+                    y = [x.float() if isinstance(x, torch.Tensor) else x for x in y]  # to FP32 for NMS
         elif self.jit:  # TorchScript
             y = self.model(im)
         elif self.dnn:  # ONNX OpenCV DNN
@@ -521,7 +576,10 @@ class DetectMultiBackend(nn.Module):
             y = self.net.forward()
         elif self.onnx:  # ONNX Runtime
             im = im.cpu().numpy()  # torch to numpy
-            y = self.session.run(self.output_names, {self.session.get_inputs()[0].name: im})
+            if self.io_binding:
+                y = self._onnx_run_with_io_binding(im)
+            else:
+                y = self.session.run(self.output_names, {self.session.get_inputs()[0].name: im})
         elif self.xml:  # OpenVINO
             im = im.cpu().numpy()  # FP32
             y = list(self.executable_network([im]).values())
@@ -585,13 +643,145 @@ class DetectMultiBackend(nn.Module):
         else:
             return self.from_numpy(y)
 
+    def _pt_compiled(self, im):
+        # PyTorch model compiled for the input shape, compiled once per shape. Eager model if compilation fails
+        key = tuple(im.shape), im.dtype, im.device, torch.is_inference_mode_enabled()  # compiled graphs guard on mode
+        if key not in self.compiled:
+            with self.compile_lock:
+                if key not in self.compiled:
+                    self.compiled[key] = self._pt_compile(im)
+        return self.compiled[key]
+
+    def _pt_compile(self, im):
+        # Compile the PyTorch model for the input shape: TorchScript trace + freeze + optimize_for_inference (frozen
+        # model cached in FUSED_DIR keyed by the weights file path, hash and input shape), or torch.compile of a copy of
+        # the model with its Detect() grids for the shape (inductor's cache on disk)
+        prefix = colorstr(f'PyTorch {self.pt_mode}:')
+        try:
+            if self.pt_mode == 'torchscript':
+                f = None
+                if self.pt_cache:
+                    stem = weights_key(self.w)
+                    name = f"{stem}-{'x'.join(map(str, im.shape))}-{str(im.dtype)[6:]}-{im.device.type}"
+                    name += '-nhwc' * self.channels_last + '-bf16' * self.bf16
+                    f = FUSED_DIR / f'{name}-torch{torch.__version__}.torchscript'
+                if f and f.exists():
+                    model = torch.jit.load(f, map_location=im.device)
+                else:
+                    self.model(im)  # build the Detect() grids for the shape before tracing
+                    with warnings.catch_warnings():
+                        warnings.filterwarnings('ignore', category=torch.jit.TracerWarning)
+                        model = torch.jit.freeze(torch.jit.trace(self.model, im, strict=False).eval())
+                    if f:
+                        f.parent.mkdir(parents=True, exist_ok=True)
+                        tmp = f.with_suffix(f'.{os.getpid()}.tmp')
+                        torch.jit.save(model, tmp)
+                        os.replace(tmp, f)  # atomic
+                        for x in f.parent.glob('*.torchscript'):
+                            if x.name.startswith(stem[:-16]) and not x.name.startswith(stem):  # older content
+                                x.unlink(missing_ok=True)
+                model = torch.jit.optimize_for_inference(model)  # not serializable, applied after loading
+            else:  # compile
+                if self.pt_cache:
+                    os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', str(FUSED_DIR / 'inductor'))
+                model = deepcopy(self.model)  # grids of this shape only, no recompilation across shapes
+                from models.experimental import Ensemble  # scoped to avoid circular import
+                if isinstance(model, Ensemble):
+                    model.threads = False  # compiled graphs only record the calling thread
+                model(im)  # build the Detect() grids for the shape before compiling
+                model = torch.compile(model, dynamic=False)
+            for _ in range(2):
+                model(im)  # compile and optimize
+            LOGGER.info(f'{prefix} compiled for input shape {tuple(im.shape)}')
+            return model
+        except Exception as e:
+            LOGGER.warning(f'WARNING ⚠️ {prefix} compilation for input shape {tuple(im.shape)} failed, eager: {e}')
+            return self.model
+
+    def forward_async(self, im, future):
+        # OpenVINO asynchronous inference on the next idle infer request of the throughput mode queue
+        # The Future is resolved from an OpenVINO thread with the output once the request completes, or its exception
+        with self.async_lock:  # blocks while all infer requests are busy
+            try:
+                self.async_queue.start_async({0: im.cpu().numpy()}, future)
+            except Exception as e:
+                future.set_exception(e)
+
+    def _openvino_callback(self, request, future):
+        # OpenVINO infer request completion callback, resolves the request's Future with the output or the exception
+        try:
+            y = [request.get_output_tensor(i).data.copy() for i in range(len(request.model_outputs))]
+            future.set_result(self.from_numpy(y[0]) if len(y) == 1 else [self.from_numpy(x) for x in y])
+        except Exception as e:  # failed request
+            future.set_exception(e)
+
+    def _onnx_run_with_io_binding(self, im):
+        # ONNX Runtime inference through IO binding of input/output buffers preallocated per input shape, pooled across
+        # threads with a set of buffers per concurrent inference. Returns copies of the outputs
+        with self.ort_lock:
+            pool = self.ort_buffers.setdefault(im.shape, [])
+            buffers = pool.pop() if pool else None
+        binding, x, y = buffers or self._onnx_io_binding(im.shape, im.dtype)
+        np.copyto(x, im)
+        self.session.run_with_iobinding(binding)
+        out = [o.copy() for o in y] if y else binding.copy_outputs_to_cpu()
+        with self.ort_lock:
+            self.ort_buffers[im.shape].append((binding, x, y))
+        return out
+
+    def _onnx_io_binding(self, shape, dtype):
+        # IO binding of a preallocated input buffer of shape and output buffers of the model's output shapes. Outputs
+        # of dynamic shape (other than the batch size) are allocated by ONNX Runtime
+        name = self.session.get_inputs()[0].name
+        x = np.empty(shape, dtype)
+        binding = self.session.io_binding()
+        binding.bind_input(name, 'cpu', 0, x.dtype, x.shape, x.ctypes.data)
+        outputs = self.session.get_outputs()
+        shapes = [[shape[0], *o.shape[1:]] for o in outputs]  # batch size of the input
+        if not all(isinstance(d, int) for s in shapes for d in s):
+            for o in outputs:
+                binding.bind_output(o.name, 'cpu')
+            return binding, x, None
+        y = [np.empty(s, np.float16 if o.type == 'tensor(float16)' else np.float32) for s, o in zip(shapes, outputs)]
+        for o, b in zip(outputs, y):
+            binding.bind_output(o.name, 'cpu', 0, b.dtype, b.shape, b.ctypes.data)
+        return binding, x, y
+
+    @staticmethod
+    def _onnx_session_options(w, options, threads=None):
+        # ONNX Runtime SessionOptions from an options dict and a threading policy (set_threads()), and the model file to
+        # load (optimized model if cached)
+        import onnxruntime as ort
+        so = ort.SessionOptions()
+        levels = {
+            'disable': ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+            'basic': ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+            'extended': ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+            'all': ort.GraphOptimizationLevel.ORT_ENABLE_ALL}
+        so.graph_optimization_level = levels[options.get('graph_optimization_level', 'all')]
+        threads = threads or {}
+        so.intra_op_num_threads = options.get('intra_op_num_threads') or threads.get('intra_op', 0)  # 0: ORT chooses
+        so.inter_op_num_threads = options.get('inter_op_num_threads') or threads.get('inter_op', 0)
+        so.execution_mode = ort.ExecutionMode.ORT_PARALLEL if options.get('execution_mode') == 'parallel' else \
+            ort.ExecutionMode.ORT_SEQUENTIAL
+        so.enable_cpu_mem_arena = options.get('enable_cpu_mem_arena', True)
+        f = options.get('optimized_model_filepath')  # optimized model cache
+        if not f:
+            return so, w
+        if Path(f).is_file() and os.path.getmtime(f) >= os.path.getmtime(w):  # cache is up to date
+            LOGGER.info(f'Loading optimized model {f} for ONNX Runtime inference...')
+            so.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL  # already optimized
+            return so, str(f)
+        so.optimized_model_filepath = str(f)  # save optimized model for next time
+        return so, w
+
     def from_numpy(self, x):
         return torch.from_numpy(x).to(self.device) if isinstance(x, np.ndarray) else x
 
-    def warmup(self, imgsz=(1, 3, 640, 640)):
-        # Warmup model by running inference once
+    def warmup(self, imgsz=(1, 3, 640, 640), cpu=False):
+        # Warmup model by running inference once, on CPU too if cpu=True
         warmup_types = self.pt, self.jit, self.onnx, self.engine, self.saved_model, self.pb, self.triton
-        if any(warmup_types) and (self.device.type != 'cpu' or self.triton):
+        if any(warmup_types) and (self.device.type != 'cpu' or self.triton) or cpu:
             im = torch.empty(*imgsz, dtype=torch.half if self.fp16 else torch.float, device=self.device)  # input
             for _ in range(2 if self.jit else 1):  #
                 self.forward(im)  # warmup
@@ -652,6 +842,8 @@ class AutoShape(nn.Module):
             m.grid = list(map(fn, m.grid))
             if isinstance(m.anchor_grid, list):
                 m.anchor_grid = list(map(fn, m.anchor_grid))
+            if getattr(m, 'grids', None) is not None:
+                m.grids = [OrderedDict((k, tuple(map(fn, g))) for k, g in c.items()) for c in m.grids]
         return self
 
     @smart_inference_mode()
@@ -3,12 +3,17 @@
 Experimental modules
 """
 import math
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import torch
 import torch.nn as nn
 
 from utils.downloads import attempt_download
+from utils.general import FUSED_DIR, LOGGER, check_version, weights_key
+from utils.torch_utils import is_compiling
 
 
 class Sum(nn.Module):
@@ -58,34 +63,94 @@ class MixConv2d(nn.Module):
 
 
 class Ensemble(nn.ModuleList):
-    # Ensemble of models
+    # Ensemble of models, run concurrently in a thread per model. Sequentially on the calling thread while traced or
+    # compiled, as torch.jit.trace() and torch.compile() do not record the work of other threads. torch.compile()
+    # resumes forward() uncompiled after graph breaks, so compiled copies also set threads=False
+    lock = threading.Lock()  # guards the creation of the thread pools
+
     def __init__(self):
         super().__init__()
+        self.pool = None  # thread pool, created on first forward
+        self.threads = True  # run the models in the thread pool
 
     def forward(self, x, augment=False, profile=False, visualize=False):
-        y = [module(x, augment, profile, visualize)[0] for module in self]
+        threads = len(self) > 1 and self.threads and not (torch.jit.is_tracing() or is_compiling())
+        if threads and self.pool is None:
+            with self.lock:
+                if self.pool is None:  # one pool for concurrent first forwards
+                    self.pool = ThreadPoolExecutor(len(self), thread_name_prefix='ensemble')
+        if threads:
+            grad, inference = torch.is_grad_enabled(), torch.is_inference_mode_enabled()  # thread-local modes
+
+            def run(module):
+                with torch.inference_mode(inference), torch.set_grad_enabled(grad):
+                    return module(x, augment, profile, visualize)[0]
+
+            y = list(self.pool.map(run, self))
+        else:
+            y = [module(x, augment, profile, visualize)[0] for module in self]
         # y = torch.stack(y).max(0)[0]  # max ensemble
         # y = torch.stack(y).mean(0)  # mean ensemble
-        y = torch.cat(y, 1)  # nms ensemble
-        return y, None  # inference, train output
-
-
-def attempt_load(weights, device=None, inplace=True, fuse=True):
+        return torch.cat(y, 1), y  # nms ensemble, per model outputs for weighted_boxes_fusion()
+
+    def __getstate__(self):
+        return {**self.__dict__, 'pool': None}  # threads are not copied
+
+
+def load_fused(f, mmap=True):
+    # Loads a cached fused model, memory-mapped if mmap (torch>=2.1). Returns None if not cached or by another torch
+    if not f or not f.exists():
+        return None
+    try:
+        kwargs = {'mmap': mmap, 'weights_only': False} if check_version(torch.__version__, '2.1.0') else {}
+        x = torch.load(f, map_location='cpu', **kwargs)
+        return x['model'] if x.get('torch') == torch.__version__ else None
+    except Exception as e:
+        LOGGER.warning(f'WARNING ⚠️ fused model cache {f} not loaded: {e}')
+        return None
+
+
+def save_fused(model, f):
+    # Caches a fused inference-ready model as f, replacing the cached models of the weights file's previous contents
+    try:
+        f.parent.mkdir(parents=True, exist_ok=True)
+        tmp = f.with_suffix(f'.{os.getpid()}.tmp')
+        torch.save({'model': model, 'torch': torch.__version__}, tmp)
+        os.replace(tmp, f)  # atomic, concurrent workers never load a partial file
+        for x in f.parent.glob('*.pt'):
+            if x != f and len(x.stem) == len(f.stem) and x.stem[:-16] == f.stem[:-16]:  # same path, older content
+                x.unlink(missing_ok=True)
+    except Exception as e:
+        LOGGER.warning(f'WARNING ⚠️ fused model cache {f} not saved: {e}')
+
+
+def attempt_load(weights, device=None, inplace=True, fuse=True, cache=True, mmap=True):
     # Loads an ensemble of models weights=[a,b,c] or a single model weights=[a] or weights=a
+    # Fused models are cached in FUSED_DIR keyed by the weights file path and hash, later loads skip the load-float-fuse
+    # steps and memory-map the cached weights (mmap), so processes loading the same weights share their physical pages
     from models.yolo import Detect, Model
 
     model = Ensemble()
     for w in weights if isinstance(weights, list) else [weights]:
-        ckpt = torch.load(attempt_download(w), map_location='cpu')  # load
-        ckpt = (ckpt.get('ema') or ckpt['model']).to(device).float()  # FP32 model
-
-        # Model compatibility updates
-        if not hasattr(ckpt, 'stride'):
-            ckpt.stride = torch.tensor([32.])
-        if hasattr(ckpt, 'names') and isinstance(ckpt.names, (list, tuple)):
-            ckpt.names = dict(enumerate(ckpt.names))  # convert to dict
-
-        model.append(ckpt.fuse().eval() if fuse and hasattr(ckpt, 'fuse') else ckpt.eval())  # model in eval mode
+        w = attempt_download(w)
+        f = FUSED_DIR / f'{weights_key(w)}.pt' if fuse and cache else None
+        ckpt = load_fused(f, mmap)
+        if ckpt is None:
+            ckpt = torch.load(w, map_location='cpu')  # load
+            ckpt = (ckpt.get('ema') or ckpt['model']).float()  # FP32 model
+
+            # Model compatibility updates
+            if not hasattr(ckpt, 'stride'):
+                ckpt.stride = torch.tensor([32.])
+            if hasattr(ckpt, 'names') and isinstance(ckpt.names, (list, tuple)):
+                ckpt.names = dict(enumerate(ckpt.names))  # convert to dict
+
+            ckpt = ckpt.fuse().eval() if fuse and hasattr(ckpt, 'fuse') else ckpt.eval()  # model in eval mode
+            if f and hasattr(ckpt, 'fuse'):
+                save_fused(ckpt, f)
+                if mmap:  # memory-mapped, sharing pages with the other processes of the weights
+                    ckpt = load_fused(f) or ckpt
+        model.append(ckpt.to(device))
 
     # Module compatibility updates
     for m in model.modules():
@@ -1,5 +1,6 @@
 import datetime
 from VideoCapture import *
+from utils.codec import CODEC
 
 
 class Scraper:
@@ -28,6 +29,15 @@ class Scraper:
         :return: frame_id: in the following format: img dir_path/imgXXXXZZZZZZZ_DD_MM_YYYYTHH_MM_SS.
         Where XXXX is the camera ID, ZZZZZZZ is the frame count and DD_MM_YYYYTHH_MM_SS is the date and the time.
         """
+        frame_id, image = self.read()
+        return self.save(image, frame_id, dir_path)
+
+    def read(self):
+        """
+        Parsing a frame from a VideoCapture read function and giving it a frame id, without saving it.
+        :return: frame_id, image: where frame_id is in the following format: imgXXXXZZZZZZZ_DD_MM_YYYYTHH_MM_SS.
+        Where XXXX is the camera ID, ZZZZZZZ is the frame count and DD_MM_YYYYTHH_MM_SS is the date and the time.
+        """
         image = self.vidcap.read()
 
         current_time = datetime.datetime.now()
@@ -38,15 +48,27 @@ class Scraper:
         minute = str(current_time.minute) if len(str(current_time.minute)) == 2 else '0' + str(current_time.minute)
         second = str(current_time.second) if len(str(current_time.second)) == 2 else '0' + str(current_time.second)
 
-        self.frame_id = dir_path + '/' + 'img' + self.id + (7 - len(str(self.counter))) * '0' + str(self.counter) \
-                        + '_' + day + '_' + month + '_' + year + 'T' + hour + '_' + minute + '_' + second + '.jpg'
-        print(self.frame_id)
-        cv2.imwrite(self.frame_id, image)
+        frame_id = 'img' + self.id + (7 - len(str(self.counter))) * '0' + str(self.counter) \
+                   + '_' + day + '_' + month + '_' + year + 'T' + hour + '_' + minute + '_' + second
 
         self.counter += 1
         if self.counter > self.max_count:
             self.reset_counter()
 
+        return frame_id, image
+
+    def save(self, image, frame_id, dir_path=''):
+        """
+        Saving a frame in a folder.
+        :param: image: the frame.
+        :param: frame_id: the frame id returned by read().
+        :param: dir_path: the name of the folder.
+        :return: frame_id: in the following format: img dir_path/imgXXXXZZZZZZZ_DD_MM_YYYYTHH_MM_SS.jpg.
+        """
+        self.frame_id = dir_path + '/' + frame_id + '.jpg'
+        print(self.frame_id)
+        CODEC.imwrite(self.frame_id, image)
+
         return self.frame_id
 
     def reset_counter(self, counter=0):
@@ -5,6 +5,9 @@ Image augmentation functions
 
 import math
 import random
+import threading
+from contextlib import contextmanager
+from functools import lru_cache
 
 import cv2
 import numpy as np
@@ -141,6 +144,89 @@ def letterbox(im, new_shape=(640, 640), color=(114, 114, 114), auto=True, scaleF
     return im, ratio, (dw, dh)
 
 
+class BufferPool:
+    # Reusable buffers pooled by key and shared by all threads, each buffer lent to one caller at a time. The pool of a
+    # key grows to the number of concurrent callers, later callers reuse the returned buffers
+    # Usage: pool = BufferPool(lambda key: np.empty(key)); with pool.lend((480, 640)) as x: ...
+    def __init__(self, new):
+        self.new = new  # buffer factory of a key
+        self.free = {}  # returned buffers per key
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def lend(self, key):
+        # Lends a free buffer of key, or a new one, for the with block
+        with self.lock:
+            free = self.free.setdefault(key, [])
+            x = free.pop() if free else None
+        x = self.new(key) if x is None else x
+        try:
+            yield x
+        finally:
+            with self.lock:
+                free.append(x)
+
+
+class LetterboxPlan:
+    # Letterbox geometry of a source shape, computed once per camera resolution. Frames are resized straight into
+    # padded buffers pooled across threads, their borders painted once. Same output as letterbox(scaleup=True)
+    # Usage: plan = LetterboxPlan.get(im.shape[:2], 640); with plan(im) as x: ...; scale_boxes(..., plan.ratio_pad)
+    def __init__(self, shape, new_shape=(640, 640), stride=32, auto=True, color=(114, 114, 114)):
+        if isinstance(new_shape, int):
+            new_shape = (new_shape, new_shape)
+        r = min(new_shape[0] / shape[0], new_shape[1] / shape[1])  # scale ratio (new / old)
+        self.shape = tuple(shape[:2])  # source shape [height, width]
+        self.new_unpad = int(round(shape[1] * r)), int(round(shape[0] * r))  # resized shape [width, height]
+        dw, dh = new_shape[1] - self.new_unpad[0], new_shape[0] - self.new_unpad[1]  # wh padding
+        if auto:  # minimum rectangle
+            dw, dh = np.mod(dw, stride), np.mod(dh, stride)
+        self.ratio, self.pad = (r, r), (dw / 2, dh / 2)  # width, height ratios and padding, for scale_boxes()
+        self.top, self.left = int(round(dh / 2 - 0.1)), int(round(dw / 2 - 0.1))
+        self.out_shape = self.new_unpad[1] + int(dh), self.new_unpad[0] + int(dw)  # letterboxed shape [height, width]
+        self.color = color
+        self.buffers = BufferPool(lambda _: np.full((*self.out_shape, 3), self.color, np.uint8))  # padded outputs
+
+    @staticmethod
+    @lru_cache(maxsize=32)
+    def get(shape, new_shape=(640, 640), stride=32, auto=True):
+        # Cached plan per (source shape, target shape, stride, auto), arguments must be hashable
+        return LetterboxPlan(shape, new_shape, stride, auto)
+
+    @property
+    def ratio_pad(self):
+        return self.ratio, self.pad
+
+    @contextmanager
+    def __call__(self, im):
+        # Letterboxes a BGR image into a padded buffer lent by the plan's pool for the with block
+        with self.buffers.lend(None) as out:
+            w, h = self.new_unpad
+            dst = out[self.top:self.top + h, self.left:self.left + w]
+            if self.shape[::-1] == self.new_unpad:
+                dst[:] = im
+            else:
+                cv2.resize(im, self.new_unpad, dst=dst, interpolation=cv2.INTER_LINEAR)
+            yield out
+
+
+INPUT_SLABS = BufferPool(lambda key: torch.empty(key[0], 3, *key[1:]))  # input batch tensors, see input_slab()
+
+
+def input_slab(n, shape):
+    # Float32 NCHW batch tensor of n images of shape (h, w) for a with block, lent by a pool of slabs per batch size and
+    # shape shared by all threads, so concurrent batches each get a slab and later batches reuse them
+    return INPUT_SLABS.lend((n, *shape))
+
+
+def bgr_to_nchw(im, out):
+    # Converts a BGR uint8 HWC image to a normalized RGB float CHW tensor out (3, h, w) in a single pass, same values as
+    # torch.from_numpy(np.ascontiguousarray(im.transpose((2, 0, 1))[::-1])).float() / 255 without its 3 extra passes
+    im = torch.from_numpy(im)
+    for c in range(3):
+        torch.div(im[..., 2 - c], 255, out=out[c])  # BGR to RGB, uint8 to float, 0 - 255 to 0.0 - 1.0
+    return out
+
+
 def random_perspective(im,
                        targets=(),
                        segments=(),
@@ -0,0 +1,108 @@
+"""
+Image codecs
+"""
+
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from utils.general import LOGGER
+
+BACKENDS = 'auto', 'turbojpeg', 'simplejpeg', 'opencv'  # libjpeg-turbo bindings (SIMD) first, OpenCV always available
+SUBSAMPLING = '444', '422', '420'  # JPEG chroma subsampling
+REDUCED_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8}  # OpenCV DCT-domain reduced JPEG decode flags
+
+
+class Codec:
+    # Image codec of the image reading and writing sites. JPEGs are encoded and decoded by the backend, other formats by
+    # OpenCV. The libjpeg-turbo backends ignore the EXIF orientation, OpenCV applies it
+    # Usage: codec = Codec('auto', quality=90); buf = codec.encode(im); im = codec.decode(buf, reduction=2)
+    def __init__(self, backend='auto', quality=95, subsampling='420'):
+        self.configure(backend, quality, subsampling)
+
+    def __str__(self):
+        return f'{self.backend} JPEG quality {self.quality}, {self.subsampling} chroma subsampling'
+
+    def configure(self, backend='auto', quality=95, subsampling='420'):
+        # Sets the backend ('auto' picks the first installed of BACKENDS), JPEG quality (0-100) and chroma subsampling
+        assert backend in BACKENDS, f'Invalid codec backend {backend}, valid backends are {BACKENDS}'
+        assert subsampling in SUBSAMPLING, f'Invalid chroma subsampling {subsampling}, valid ones are {SUBSAMPLING}'
+        self.backend, self.lib = self._load(backend)
+        self.quality, self.subsampling = int(quality), subsampling
+        self.exif = self.backend == 'opencv'  # decoded images are rotated by their EXIF orientation
+        return self
+
+    def encode(self, im, ext='.jpg'):
+        # Encodes a BGR image to the bytes of an ext file
+        if ext.lower() not in ('.jpg', '.jpeg'):
+            return cv2.imencode(ext, im)[1].tobytes()
+        if self.backend == 'turbojpeg':
+            from turbojpeg import TJPF_BGR, TJSAMP_420, TJSAMP_422, TJSAMP_444
+            subsample = {'444': TJSAMP_444, '422': TJSAMP_422, '420': TJSAMP_420}[self.subsampling]
+            return self.lib.encode(im, quality=self.quality, pixel_format=TJPF_BGR, jpeg_subsample=subsample)
+        if self.backend == 'simplejpeg':
+            im = np.ascontiguousarray(im)
+            return self.lib.encode_jpeg(im, self.quality, colorspace='BGR', colorsubsampling=self.subsampling)
+        params = [cv2.IMWRITE_JPEG_QUALITY, self.quality]
+        if hasattr(cv2, 'IMWRITE_JPEG_SAMPLING_FACTOR'):  # OpenCV>=4.5.5
+            factor = getattr(cv2, f'IMWRITE_JPEG_SAMPLING_FACTOR_{self.subsampling}')
+            params += [cv2.IMWRITE_JPEG_SAMPLING_FACTOR, factor]
+        return cv2.imencode('.jpg', im, params)[1].tobytes()
+
+    def decode(self, buf, reduction=1):
+        # Decodes the bytes of an image file to a BGR image, JPEGs at 1/reduction (1, 2, 4 or 8) resolution in the DCT
+        # domain. Returns None if buf is not a decodable image
+        buf = np.frombuffer(buf, np.uint8)
+        if buf[:2].tobytes() == b'\xff\xd8':  # JPEG
+            try:
+                if self.backend == 'turbojpeg':
+                    from turbojpeg import TJPF_BGR
+                    return self.lib.decode(buf.tobytes(), pixel_format=TJPF_BGR, scaling_factor=(1, reduction))
+                if self.backend == 'simplejpeg':
+                    h, w = self.lib.decode_jpeg_header(buf)[:2]
+                    return self.lib.decode_jpeg(buf, colorspace='BGR', min_height=-(-h // reduction),
+                                                min_width=-(-w // reduction))
+            except (OSError, ValueError):  # corrupt JPEG, OpenCV returns None too
+                return None
+        return cv2.imdecode(buf, REDUCED_FLAGS[reduction])
+
+    def imwrite(self, path, im):
+        # Writes a BGR image to path, format by suffix. Returns True on success, like cv2.imwrite()
+        try:
+            data = self.encode(im, Path(path).suffix)
+            with open(path, 'wb') as f:
+                f.write(data)
+            return True
+        except Exception:
+            return False
+
+    def imread(self, path, reduction=1):
+        # Reads a BGR image from path, JPEGs at 1/reduction resolution. Returns None if unreadable, like cv2.imread()
+        try:
+            return self.decode(np.fromfile(path, np.uint8), reduction)
+        except OSError:
+            return None
+
+    @staticmethod
+    def _load(backend):
+        # Returns the first installed backend of backend ('auto' tries the libjpeg-turbo bindings) and its library
+        for name in ('turbojpeg', 'simplejpeg') if backend == 'auto' else (backend,):
+            try:
+                if name == 'turbojpeg':
+                    from turbojpeg import TurboJPEG
+                    return name, TurboJPEG()  # raises RuntimeError without the libturbojpeg shared library
+                if name == 'simplejpeg':
+                    import simplejpeg
+                    return name, simplejpeg
+            except (ImportError, OSError, RuntimeError) as e:
+                if backend != 'auto':
+                    LOGGER.warning(f'WARNING ⚠️ {name} codec not available, using OpenCV: {e}')
+        return 'opencv', cv2
+
+
+CODEC = Codec()  # process-wide codec of the image reading and writing sites, set up with CODEC.configure()
@@ -30,6 +30,7 @@ from tqdm import tqdm
 
 from utils.augmentations import (Albumentations, augment_hsv, classify_albumentations, classify_transforms, copy_paste,
                                  cutout, letterbox, mixup, random_perspective)
+from utils.codec import CODEC
 from utils.general import (DATASETS_DIR, LOGGER, NUM_THREADS, check_dataset, check_requirements, check_yaml, clean_str,
                            colorstr, cv2, is_colab, is_kaggle, segments2boxes, unzip_file, xyn2xy, xywh2xyxy,
                            xywhn2xyxy, xyxy2xywhn)
@@ -94,6 +95,22 @@ def exif_transpose(image):
     return image
 
 
+def imread_reduced(path, img_size=640):
+    # Reads a BGR image, JPEGs at least 2x larger than img_size decoded at 1/2, 1/4 or 1/8 resolution in the DCT domain
+    # while staying at least img_size. Returns the image, its reduction (original pixels per decoded pixel) and the
+    # original image shape (h, w)
+    h, w = img_size if isinstance(img_size, (list, tuple)) else (img_size, img_size)
+    try:
+        with Image.open(path) as img:  # header only
+            jpeg, (w0, h0) = img.format == 'JPEG', exif_size(img) if CODEC.exif else img.size
+    except Exception:
+        jpeg, w0, h0 = False, 0, 0
+    s = max(h0 / h, w0 / w)  # letterbox downscale of the original image
+    f = next((f for f in (8, 4, 2) if jpeg and f <= s), 1)
+    im = CODEC.imread(path, f)  # BGR
+    return im, f, (h0, w0) if f > 1 or im is None else im.shape[:2]
+
+
 def seed_worker(worker_id):
     # Set dataloader worker seed https://pytorch.org/docs/stable/notes/randomness.html#dataloader
     worker_seed = torch.initial_seed() % 2 ** 32
@@ -238,7 +255,7 @@ class LoadScreenshots:
 
 class LoadImages:
     # YOLOv5 image/video dataloader, i.e. `python detect.py --source image.jpg/vid.mp4`
-    def __init__(self, path, img_size=640, stride=32, auto=True, transforms=None, vid_stride=1):
+    def __init__(self, path, img_size=640, stride=32, auto=True, transforms=None, vid_stride=1, reduce=False):
         files = []
         for p in sorted(path) if isinstance(path, (list, tuple)) else [path]:
             p = str(Path(p).resolve())
@@ -264,6 +281,8 @@ class LoadImages:
         self.auto = auto
         self.transforms = transforms  # optional
         self.vid_stride = vid_stride  # video frame-rate stride
+        self.reduce = reduce  # reduced-resolution decode of JPEGs at least 2x larger than img_size
+        self.reduction, self.shape0 = 1, None  # original pixels per im0 pixel and original (h, w) of the last image
         if any(videos):
             self._new_video(videos[0])  # new video
         else:
@@ -279,6 +298,7 @@ class LoadImages:
         if self.count == self.nf:
             raise StopIteration
         path = self.files[self.count]
+        self.reduction, self.shape0 = 1, None  # full resolution
 
         if self.video_flag[self.count]:
             # Read video
@@ -302,7 +322,10 @@ class LoadImages:
         else:
             # Read image
             self.count += 1
-            im0 = cv2.imread(path)  # BGR
+            if self.reduce:
+                im0, self.reduction, self.shape0 = imread_reduced(path, self.img_size)  # BGR
+            else:
+                im0 = CODEC.imread(path)  # BGR
             assert im0 is not None, f'Image Not Found {path}'
             s = f'image {self.count}/{self.nf} {path}: '
 
@@ -5,6 +5,7 @@ General utils
 
 import contextlib
 import glob
+import hashlib
 import inspect
 import logging
 import math
@@ -15,6 +16,7 @@ import re
 import shutil
 import signal
 import sys
+import threading
 import time
 import urllib
 from copy import deepcopy
@@ -147,6 +149,7 @@ def user_config_dir(dir='Ultralytics', env_var='YOLOV5_CONFIG_DIR'):
 
 
 CONFIG_DIR = user_config_dir()  # Ultralytics settings dir
+FUSED_DIR = Path(os.getenv('YOLOv5_FUSED_DIR', CONFIG_DIR / 'fused'))  # fused models cache dir
 
 
 class Profile(contextlib.ContextDecorator):
@@ -169,6 +172,31 @@ class Profile(contextlib.ContextDecorator):
         return time.time()
 
 
+class PeakMemory(contextlib.ContextDecorator):
+    # Peak process RSS sampler. Usage: @PeakMemory() decorator or 'with PeakMemory() as mem:' context manager
+    def __init__(self, interval=0.005):
+        self.interval = interval  # sampling interval (s)
+
+    def __enter__(self):
+        import psutil
+        self.process = psutil.Process()
+        self.start = self.peak = self.process.memory_info().rss  # bytes
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.stopped.set()
+        self.thread.join()
+        self.end = self.process.memory_info().rss
+        self.peak = max(self.peak, self.end)
+
+    def _sample(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, self.process.memory_info().rss)
+
+
 class Timeout(contextlib.ContextDecorator):
     # YOLOv5 Timeout class. Usage: @Timeout(seconds) decorator or 'with Timeout(seconds):' context manager
     def __init__(self, seconds, *, timeout_msg='', suppress_timeout_errors=True):
@@ -239,6 +267,22 @@ def init_seeds(seed=0, deterministic=False):
         os.environ['PYTHONHASHSEED'] = str(seed)
 
 
+def set_threads(intra_op=0, inter_op=0, opencv=0, **kwargs):
+    # Apply a threading policy to the process: PyTorch intra-op and inter-op threads, OpenCV threads and the OpenMP/MKL
+    # runtimes started afterwards. intra_op=0 uses one thread per CPU core available to the process, inter_op=0 keeps
+    # the runtimes' defaults. Returns the resolved policy for the inference sessions, see DetectMultiBackend
+    intra_op = intra_op or (len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count())
+    os.environ['OMP_NUM_THREADS'] = os.environ['MKL_NUM_THREADS'] = str(intra_op)
+    torch.set_num_threads(intra_op)
+    if inter_op and torch.get_num_interop_threads() != inter_op:
+        try:
+            torch.set_num_interop_threads(inter_op)  # once per process, before any inter-op parallel work
+        except RuntimeError as e:
+            LOGGER.warning(f'WARNING ⚠️ PyTorch inter-op threads are {torch.get_num_interop_threads()}: {e}')
+    cv2.setNumThreads(opencv)
+    return {**kwargs, 'intra_op': intra_op, 'inter_op': inter_op, 'opencv': opencv}
+
+
 def intersect_dicts(da, db, exclude=()):
     # Dictionary intersection of matching keys and shapes, omitting 'exclude' keys, using da values
     return {k: v for k, v in da.items() if k in db and all(x not in k for x in exclude) and v.shape == db[k].shape}
@@ -280,6 +324,22 @@ def file_size(path):
         return 0.0
 
 
+def file_hash(path, chunk=1 << 20):
+    # Return SHA-256 hex digest of a file's contents
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for b in iter(lambda: f.read(chunk), b''):
+            h.update(b)
+    return h.hexdigest()
+
+
+def weights_key(path):
+    # Return the cache key of a weights file, f'{name}-{resolved path hash}-{content hash}'. Weights with the same name
+    # in other directories get other keys, the keys of a file's previous contents share its name and path hash prefix
+    path = Path(path).resolve()
+    return f'{path.stem}-{hashlib.sha256(str(path).encode()).hexdigest()[:8]}-{file_hash(path)[:16]}'
+
+
 def check_online():
     # Check internet connectivity
     import socket
@@ -966,6 +1026,54 @@ def non_max_suppression(
     return output
 
 
+def weighted_boxes_fusion(
+        predictions,
+        conf_thres=0.25,
+        iou_thres=0.55,
+        classes=None,
+        agnostic=False,
+        max_det=300,
+        weights=None,  # per model weights, 1 by default
+):
+    """Weighted Boxes Fusion (WBF) of the inference outputs of an ensemble of models https://arxiv.org/abs/1910.13302
+    The models' detections (NMS per model) overlapping by more than iou_thres are fused into one box, averaged weighted
+    by confidence, with the average confidence scaled by the fraction of the models that detected it
+
+    Returns:
+         list of detections, on (n,6) tensor per image [xyxy, conf, cls]
+    """
+
+    n = len(predictions)  # number of models
+    w = torch.ones(n) if weights is None else torch.as_tensor(weights, dtype=torch.float)
+    max_wh = 7680  # (pixels) maximum box width and height
+    detections = [non_max_suppression(x, conf_thres, iou_thres, classes, agnostic, max_det=max_det)
+                  for x in predictions]
+    output = []
+    for x in zip(*detections):  # per image, per model detections
+        weight = torch.cat([torch.full((len(d),), float(w[k]), device=d.device) for k, d in enumerate(x)])
+        x = torch.cat(x)
+        if not x.shape[0]:  # no boxes
+            output.append(x)
+            continue
+
+        # Clusters, each box belongs to its most confident overlapping cluster leader (the leaders are NMS' boxes)
+        c = x[:, 5:6] * (0 if agnostic else max_wh)  # classes
+        boxes, scores = x[:, :4] + c, x[:, 4]  # boxes (offset by class), scores
+        i = torchvision.ops.nms(boxes, scores, iou_thres)  # leaders, sorted by confidence
+        j = (box_iou(boxes[i], boxes) > iou_thres).float().argmax(0)  # cluster of each box
+
+        # Fused boxes
+        sw = scores * weight  # weighted confidences
+        conf = torch.zeros(len(i), device=x.device).index_add_(0, j, sw)
+        box = torch.zeros((len(i), 4), device=x.device).index_add_(0, j, x[:, :4] * sw[:, None]) / conf[:, None]
+        m = torch.zeros(len(i), device=x.device).index_add_(0, j, torch.ones_like(sw))  # boxes per cluster
+        conf *= m.clamp(max=n) / m / w.sum()  # weighted average confidence, scaled by the models agreeing
+        x = torch.cat((box, conf[:, None], x[i, 5:6]), 1)
+        x = x[conf > conf_thres]
+        output.append(x[x[:, 4].argsort(descending=True)[:max_det]])
+    return output
+
+
 def strip_optimizer(f='best.pt', s=''):  # from utils.general import *; strip_optimizer()
     # Strip optimizer from 'f' to finalize training, optionally save as 's'
     x = torch.load(f, map_location=torch.device('cpu'))
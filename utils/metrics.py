@@ -123,6 +123,55 @@ def compute_ap(recall, precision):
     return ap, mpre, mrec
 
 
+def process_batch(detections, labels, iouv):
+    """
+    Return correct prediction matrix
+    Arguments:
+        detections (array[N, 6]), x1, y1, x2, y2, conf, class
+        labels (array[M, 5]), class, x1, y1, x2, y2
+        iouv (array[10]), IoU thresholds
+    Returns:
+        correct (array[N, 10]), for 10 IoU levels
+    """
+    correct = np.zeros((detections.shape[0], iouv.shape[0])).astype(bool)
+    iou = box_iou(labels[:, 1:], detections[:, :4])
+    correct_class = labels[:, 0:1] == detections[:, 5]
+    for i in range(len(iouv)):
+        x = torch.where((iou >= iouv[i]) & correct_class)  # IoU > threshold and classes match
+        if x[0].shape[0]:
+            matches = torch.cat((torch.stack(x, 1), iou[x[0], x[1]][:, None]), 1).cpu().numpy()  # [label, det, iou]
+            if x[0].shape[0] > 1:
+                matches = matches[matches[:, 2].argsort()[::-1]]
+                matches = matches[np.unique(matches[:, 1], return_index=True)[1]]
+                matches = matches[np.unique(matches[:, 0], return_index=True)[1]]
+            correct[matches[:, 1].astype(int), i] = True
+    return torch.tensor(correct, dtype=torch.bool, device=iouv.device)
+
+
+def detections_ap(preds, refs, names=()):
+    """ Average precision of detections against reference detections, i.e. an INT8 model against its FP32 model.
+    # Arguments
+        preds:  Per image detections (list of Tensor[N, 6]), x1, y1, x2, y2, conf, class.
+        refs:  Per image reference detections in the same format, used as labels.
+        names:  Class names (dict).
+    # Returns
+        Per class precision, recall, mAP@0.5 and mAP@0.5:0.95, and the classes that have reference detections.
+    """
+    iouv = torch.linspace(0.5, 0.95, 10)  # iou vector for mAP@0.5:0.95
+    stats = []
+    for pred, ref in zip(preds, refs):
+        labels = ref[:, [5, 0, 1, 2, 3]].cpu()
+        pred = pred.cpu()
+        correct = process_batch(pred, labels, iouv) if len(labels) else torch.zeros(len(pred), 10, dtype=torch.bool)
+        stats.append((correct, pred[:, 4], pred[:, 5], labels[:, 0]))
+    stats = [torch.cat(x, 0).numpy() for x in zip(*stats)]
+    names = names if isinstance(names, dict) else dict(enumerate(names))
+    if not len(stats) or not stats[3].size:  # no reference detections
+        return np.zeros(0), np.zeros(0), np.zeros(0), np.zeros(0), np.zeros(0, dtype=int)
+    tp, fp, p, r, f1, ap, ap_class = ap_per_class(*stats, names=names)
+    return p, r, ap[:, 0], ap.mean(1), ap_class
+
+
 class ConfusionMatrix:
     # Updated version of https://github.com/kaanakan/object_detection_confusion_matrix
     def __init__(self, nc, conf=0.25, iou_thres=0.45):
@@ -147,6 +147,12 @@ def time_sync():
     return time.time()
 
 
+def is_compiling():
+    # Return True while torch.compile traces the model (torch>=2.3)
+    compiler = getattr(torch, 'compiler', None)
+    return bool(compiler and hasattr(compiler, 'is_compiling') and compiler.is_compiling())
+
+
 def profile(input, ops, n=10, device=None):
     """ YOLOv5 speed/memory/FLOPs profiler
     Usage:
@@ -0,0 +1,166 @@
+import argparse
+import os
+import queue
+import subprocess
+import sys
+import threading
+
+from concurrent.futures import Future
+from multiprocessing.connection import Client, Listener
+
+
+class WorkerPool:
+    """
+    Class WorkerPool.
+    Running the model in several inference processes, each owning its own inference engine and pinned to a disjoint
+    set of CPU cores with its own number of intra-op threads.
+    Frames are queued by the server process and inferred by the next idle worker.
+    """
+    def __init__(self, weights, workers=2, threads=None, **kwargs):
+        """
+        :param: weights: the model's weights.
+        :param: workers: the number of inference processes.
+        :param: threads: the number of intra-op threads per worker. Defaults to the number of cores of the worker.
+        :param: kwargs: Model arguments, i.e. imgsz.
+        :return: a WorkerPool instance.
+        """
+        cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+        n = max(len(cores) // workers, 1)  # cores per worker
+        self.cores = [cores[i * n:(i + 1) * n] or cores for i in range(workers)]
+        self.queue = queue.Queue()
+
+        # start the worker processes, each connects back to the server process
+        authkey = os.urandom(16)
+        listener = Listener(('127.0.0.1', 0), authkey=authkey)
+        env = dict(os.environ, WORKER_AUTHKEY=authkey.hex())
+        self.processes = []
+        for c in self.cores:
+            t = threads or len(c)
+            args = [sys.executable, os.path.abspath(__file__), '--address', '%s:%d' % listener.address,
+                    '--cores', ','.join(map(str, c)), '--threads', str(t)]
+            self.processes.append(subprocess.Popen(args, env=dict(env, OMP_NUM_THREADS=str(t))))
+
+        # load and warm up the model in every worker and start a dispatching thread per worker
+        self.pids = []
+        for _ in self.processes:
+            conn = listener.accept()
+            conn.send((weights, kwargs))
+            self.pids.append(conn.recv())  # worker is ready
+            t = threading.Thread(target=self._dispatch, args=(conn,))
+            t.daemon = True
+            t.start()
+        listener.close()
+
+    def submit(self, frames, ids=None, **kwargs):
+        """
+        Queueing frames for the next idle worker.
+        :param: frames: list of BGR images.
+        :param: ids: list of image IDs, one per frame.
+        :param: kwargs: inference arguments for Model.infer(), i.e. conf_thres.
+        :return: a Future of the frames' list of output dictionaries.
+        """
+        future = Future()
+        self.queue.put((frames, ids, kwargs, future))
+        return future
+
+    def infer(self, frame, image_id, timeout=None, **kwargs):
+        """
+        Inferring a frame on the next idle worker, waiting for its output.
+        :param: frame: BGR image.
+        :param: image_id: the frame's image ID.
+        :param: timeout: the maximum time (seconds) to wait for the output. None waits forever.
+        :param: kwargs: inference arguments for Model.infer(), i.e. conf_thres.
+        :return: output dictionary in the format {"image_id": ..., "detection_results": ...}
+        """
+        return self.submit([frame], [image_id], **kwargs).result(timeout)[0]
+
+    def memory(self):
+        """
+        Measuring the memory of every worker process. PSS splits the shared pages (i.e. the memory-mapped weights)
+        among the processes sharing them and USS counts the worker's private pages only.
+        :return: list of dictionaries in the format {"pid": ..., "rss_mb": ..., "pss_mb": ..., "uss_mb": ...}, one per
+        worker.
+        """
+        import psutil
+
+        memory = []
+        for pid in self.pids:
+            m = psutil.Process(pid).memory_full_info()
+            mb = {f'{k}_mb': round(getattr(m, k) / (1 << 20), 1) for k in ('rss', 'pss', 'uss')}
+            memory.append({'pid': pid, **mb})
+        return memory
+
+    def close(self):
+        """
+        Stopping the worker processes.
+        """
+        for _ in self.processes:
+            self.queue.put(None)
+        for p in self.processes:
+            p.wait()
+
+    def _dispatch(self, conn):
+        """
+        Sending queued frames to a worker and setting their future with the worker's outputs.
+        :param: conn: the connection to the worker.
+        """
+        while True:
+            job = self.queue.get()
+            if job is None:
+                conn.close()
+                break
+            frames, ids, kwargs, future = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                conn.send((frames, ids, kwargs))
+                output = conn.recv()
+            except (EOFError, OSError) as e:  # worker died, fail its frames and stop dispatching to it
+                future.set_exception(e)
+                break
+            if isinstance(output, Exception):
+                future.set_exception(output)
+            else:
+                future.set_result(output)
+
+
+def work(address, cores, threads):
+    """
+    Running an inference worker process: pinning it to its cores, loading the model and inferring received frames.
+    :param: address: the server process address (host:port).
+    :param: cores: the CPU cores to run on.
+    :param: threads: the number of intra-op threads.
+    """
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    os.environ['OMP_NUM_THREADS'] = str(threads)  # before importing torch
+
+    from model import Model
+    from utils.general import set_threads
+
+    host, port = address.split(':')
+    conn = Client((host, int(port)), authkey=bytes.fromhex(os.environ['WORKER_AUTHKEY']))
+    weights, kwargs = conn.recv()
+    kwargs['thread_options'] = set_threads(**{**(kwargs.get('thread_options') or {}), 'intra_op': threads})
+    model = Model(weights, **kwargs)
+    model.warmup()
+    conn.send(os.getpid())
+
+    while True:
+        try:
+            frames, ids, kwargs = conn.recv()
+        except EOFError:  # server process closed the connection
+            break
+        try:
+            conn.send(model.infer(frames, ids=ids, **kwargs))
+        except Exception as e:
+            conn.send(e)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--address', type=str, help='server process address (host:port)')
+    parser.add_argument('--cores', type=str, help='comma separated CPU cores to pin the worker to')
+    parser.add_argument('--threads', type=int, help='intra-op threads')
+    opt = parser.parse_args()
+    work(opt.address, [int(c) for c in opt.cores.split(',')], opt.threads)